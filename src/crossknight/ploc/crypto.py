@@ -0,0 +1,239 @@
+# coding:utf-8
+from collections import OrderedDict
+from functools import lru_cache
+import hmac as hmaclib
+from importlib import import_module
+# noinspection PyPackageRequirements
+from secrets import token_bytes
+from threading import Lock
+from time import monotonic
+
+
+_KEY_CACHE_SIZE = 64
+_KEY_CACHE_TTL = 600
+_HKDF_INFO = b"ploc note key"
+SESSION_KDF = "hkdf-sha256"
+
+
+def _pure_argon2d(pass_b, salt_b):
+    from argon2pure import argon2
+    from argon2pure import ARGON2D
+    return argon2(pass_b, salt_b, 10, 1024, 1, tag_length=32, type_code=ARGON2D)
+
+
+def _pure_encrypter(key, iv):
+    from pyaes import AESModeOfOperationCBC
+    from pyaes import Encrypter
+    return Encrypter(AESModeOfOperationCBC(key, iv))
+
+
+def _pure_decrypter(key, iv):
+    from pyaes import AESModeOfOperationCBC
+    from pyaes import Decrypter
+    return Decrypter(AESModeOfOperationCBC(key, iv))
+
+
+def _native_argon2d(pass_b, salt_b):
+    # noinspection PyPackageRequirements
+    from argon2.low_level import hash_secret_raw
+    # noinspection PyPackageRequirements
+    from argon2.low_level import Type
+    return hash_secret_raw(pass_b, salt_b, 10, 1024, 1, 32, Type.D, 0x13)
+
+
+def _native_cipher(key, iv):
+    # noinspection PyPackageRequirements
+    from cryptography.hazmat.backends import default_backend
+    # noinspection PyPackageRequirements
+    from cryptography.hazmat.primitives.ciphers import algorithms
+    # noinspection PyPackageRequirements
+    from cryptography.hazmat.primitives.ciphers import Cipher
+    # noinspection PyPackageRequirements
+    from cryptography.hazmat.primitives.ciphers import modes
+    return Cipher(algorithms.AES(key), modes.CBC(iv), default_backend())
+
+
+def _native_padding():
+    # noinspection PyPackageRequirements
+    from cryptography.hazmat.primitives.padding import PKCS7
+    return PKCS7(128)
+
+
+class _NativeEncrypter(object):
+    def __init__(self, key, iv):
+        self.__padder = _native_padding().padder()
+        self.__context = _native_cipher(key, iv).encryptor()
+
+    def feed(self, data=None):
+        if data is None:
+            return self.__context.update(self.__padder.finalize()) + self.__context.finalize()
+        return self.__context.update(self.__padder.update(data))
+
+
+class _NativeDecrypter(object):
+    def __init__(self, key, iv):
+        self.__unpadder = _native_padding().unpadder()
+        self.__context = _native_cipher(key, iv).decryptor()
+
+    def feed(self, data=None):
+        if data is None:
+            return self.__unpadder.update(self.__context.finalize()) + self.__unpadder.finalize()
+        return self.__unpadder.update(self.__context.update(data))
+
+
+def _can_import(name, *symbols):
+    try:
+        module = import_module(name)
+    except ImportError:
+        return False
+    return all(hasattr(module, symbol) for symbol in symbols)
+
+
+@lru_cache(maxsize=None)
+def has_native_argon2():
+    return _can_import("argon2.low_level", "hash_secret_raw", "Type")
+
+
+@lru_cache(maxsize=None)
+def has_native_aes():
+    return _can_import("cryptography.hazmat.backends", "default_backend") and\
+        _can_import("cryptography.hazmat.primitives.ciphers", "algorithms", "Cipher", "modes") and\
+        _can_import("cryptography.hazmat.primitives.padding", "PKCS7")
+
+
+def _auto_argon2d(pass_b, salt_b):
+    return (_native_argon2d if has_native_argon2() else _pure_argon2d)(pass_b, salt_b)
+
+
+def _auto_encrypter(key, iv):
+    return (_NativeEncrypter if has_native_aes() else _pure_encrypter)(key, iv)
+
+
+def _auto_decrypter(key, iv):
+    return (_NativeDecrypter if has_native_aes() else _pure_decrypter)(key, iv)
+
+
+class Backend(object):
+    def __init__(self, name, argon2d, encrypter, decrypter):
+        self.name = name
+        self.argon2d = argon2d
+        self.encrypter = encrypter
+        self.decrypter = decrypter
+
+    def encrypt(self, key, iv, data):
+        encrypter = self.encrypter(key, iv)
+        return encrypter.feed(data) + encrypter.feed()
+
+    def decrypt(self, key, iv, data):
+        decrypter = self.decrypter(key, iv)
+        return decrypter.feed(data) + decrypter.feed()
+
+
+PURE_BACKEND = Backend("pure", _pure_argon2d, _pure_encrypter, _pure_decrypter)
+NATIVE_BACKEND = Backend("native", _auto_argon2d, _auto_encrypter, _auto_decrypter)
+backend = NATIVE_BACKEND
+
+
+class KeyCache(object):
+    def __init__(self, maxsize=_KEY_CACHE_SIZE, ttl=_KEY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__secret = token_bytes(32)
+        self.__keys = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __id(self, password, salt_b):
+        return hmaclib.new(self.__secret, salt_b + bytes(password, "utf-8"), "sha256").digest()
+
+    def __evict(self, entryId):
+        key, _ = self.__keys.pop(entryId)
+        key[:] = bytes(len(key))
+
+    def get(self, password, salt_b):
+        entryId = self.__id(password, salt_b)
+        with self.__lock:
+            if entryId not in self.__keys:
+                return None
+            key, expiry = self.__keys[entryId]
+            if expiry <= monotonic():
+                self.__evict(entryId)
+                return None
+            self.__keys.move_to_end(entryId)
+            return bytes(key)
+
+    def put(self, password, salt_b, key):
+        if self.maxsize <= 0:
+            return
+        entryId = self.__id(password, salt_b)
+        with self.__lock:
+            if entryId in self.__keys:
+                self.__evict(entryId)
+            self.__keys[entryId] = (bytearray(key), monotonic() + self.ttl)
+            while len(self.__keys) > self.maxsize:
+                self.__evict(next(iter(self.__keys)))
+
+    def wipe(self):
+        with self.__lock:
+            while self.__keys:
+                self.__evict(next(iter(self.__keys)))
+
+
+key_cache = KeyCache()
+verified_cache = KeyCache()
+
+
+def pass2key(password, salt_b):
+    key = key_cache.get(password, salt_b)
+    if key is None:
+        key = backend.argon2d(bytes(password, "utf-8"), salt_b)
+        key_cache.put(password, salt_b, key)
+    return key
+
+
+def _feed_stream(feeder, chunks):
+    for chunk in chunks:
+        data = feeder.feed(chunk)
+        if data:
+            yield data
+    yield feeder.feed()
+
+
+def aes_encrypt_stream(key, iv, chunks):
+    return _feed_stream(backend.encrypter(key, iv), chunks)
+
+
+def aes_decrypt_stream(key, iv, chunks):
+    return _feed_stream(backend.decrypter(key, iv), chunks)
+
+
+def hkdf(key, salt_b, info=_HKDF_INFO):
+    prk = hmaclib.new(salt_b, key, "sha256").digest()
+    return hmaclib.new(prk, info + b"\x01", "sha256").digest()
+
+
+def wipe_keys():
+    key_cache.wipe()
+    verified_cache.wipe()
+
+
+class Keyring(object):
+    def __init__(self, password):
+        self.password = password
+        self.salt = token_bytes(16)
+        self.__masters = {}
+
+    def master(self, salt_b):
+        if salt_b not in self.__masters:
+            self.__masters[salt_b] = bytearray(pass2key(self.password, salt_b))
+        return bytes(self.__masters[salt_b])
+
+    def derive(self, masterSalt_b, salt_b):
+        return hkdf(self.master(masterSalt_b), salt_b)
+
+    def wipe(self):
+        for master in self.__masters.values():
+            master[:] = bytes(len(master))
+        self.__masters.clear()
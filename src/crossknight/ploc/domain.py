@@ -1,31 +1,165 @@
 # coding:utf-8
-from argon2pure import argon2
-from argon2pure import ARGON2D
 from base64 import standard_b64decode
 from base64 import standard_b64encode
 from binascii import hexlify
 from collections import OrderedDict
+from codecs import getincrementaldecoder
+from crossknight.ploc.crypto import aes_decrypt_stream
+from crossknight.ploc.crypto import aes_encrypt_stream
+from crossknight.ploc.crypto import Keyring
+from crossknight.ploc.crypto import pass2key
+from crossknight.ploc.crypto import SESSION_KDF
+from crossknight.ploc.crypto import verified_cache
 from datetime import datetime
 from enum import Enum
 import hmac as hmaclib
-from pyaes import AESModeOfOperationCBC
-from pyaes import Decrypter
-from pyaes import Encrypter
+from itertools import repeat
 from re import compile
+from re import X
 # noinspection PyPackageRequirements
 from secrets import token_bytes
 from uuid import uuid4
-from yaml import dump_all
-from yaml import safe_load
-from yaml import SafeDumper
 
 
 _UUID = compile(r"^[0-9a-f]{32}\Z")
+_CHUNK_SIZE = 1 << 16
+_OrderedSafeDumper = None
+_YAML_WIDTH = 80
+_YAML_LINE = compile("[\x20-\x7E\xA0-\u2027\u202A-\uD7FF\uE000-\uFEFE\uFF00-\uFFFD]*\\Z")
+_YAML_IMPLICIT = compile(r"""^(?:yes|Yes|YES|no|No|NO|true|True|TRUE|false|False|FALSE|on|On|ON|off|Off|OFF
+                         |[-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+][0-9]+)?
+                         |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\.[0-9_]*
+                         |[-+]?\.(?:inf|Inf|INF)
+                         |[-+]?0b[0-1_]+
+                         |[-+]?0[0-7_]+
+                         |[-+]?(?:0|[1-9][0-9_]*)
+                         |[-+]?0x[0-9a-fA-F_]+
+                         |[-+]?[1-9][0-9_]*(?::[0-5]?[0-9])+
+                         |<<|~|null|Null|NULL|=
+                         |[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]
+                         |[0-9][0-9][0-9][0-9]-[0-9][0-9]?-[0-9][0-9]?(?:[Tt]|[ \t]+)[0-9][0-9]?:[0-9][0-9]:[0-9][0-9]
+                          (?:\.[0-9]*)?(?:[ \t]*(?:Z|[-+][0-9][0-9]?(?::[0-9][0-9])?))?)$""", X)
+
+
+def _is_yaml_plain(value):
+    return not (value[0] in " #,[]{}&*!|>'\"%@`" or value[-1] == " " or value.startswith(("---", "...")) or
+                (value[0] in "?:-" and value[1:2] in ("", " ")) or value.endswith(":") or ": " in value or
+                " #" in value or _YAML_IMPLICIT.match(value))
+
+
+def _is_yaml_key(key):
+    return key.isalpha() and key.isascii() and not _YAML_IMPLICIT.match(key)
+
+
+def _dump_yaml_scalar(value, column):
+    if type(value) != str or value[:1] == "." or not _YAML_LINE.match(value):
+        return None
+    if value and _is_yaml_plain(value):
+        scalar = value
+    else:
+        scalar = "'" + value.replace("'", "''") + "'"
+    return scalar if column + len(scalar) <= _YAML_WIDTH else None
+
+
+def _load_yaml_scalar(scalar):
+    if len(scalar) >= 2 and scalar[0] == "'" and scalar[-1] == "'":
+        value = scalar[1:-1]
+        if "'" in value.replace("''", "") or not _YAML_LINE.match(value):
+            return None
+        return value.replace("''", "'")
+    if scalar and scalar[0] != "." and _YAML_LINE.match(scalar) and _is_yaml_plain(scalar):
+        return scalar
+    return None
+
+
+def _dump_header(noteDict):
+    lines = []
+    for (key, value) in noteDict.items():
+        if type(value) == list:
+            lines.append(key + (":" if value else ": []"))
+            items = [("  - ", item) for item in value]
+        elif type(value) == OrderedDict:
+            lines.append(key + ":")
+            items = [("  " + subkey + ": ", item) for (subkey, item) in value.items()]
+        else:
+            items = [(key + ": ", value)]
+        for (prefix, item) in items:
+            scalar = _dump_yaml_scalar(item, len(prefix))
+            if scalar is None:
+                return None
+            lines.append(prefix + scalar)
+    return "\n".join(lines)
+
+
+def _load_header(header):
+    entries = []
+    for line in header.split("\n"):
+        if line.startswith("  ") and entries:
+            entries[-1][1].append(line[2:])
+        else:
+            entries.append((line, []))
+
+    noteDict = {}
+    for (line, children) in entries:
+        if children and line.endswith(":") and all(c.startswith("- ") for c in children):
+            key = line[:-1]
+            value = [_load_yaml_scalar(c[2:]) for c in children]
+            if None in value:
+                return None
+        elif children and line.endswith(":"):
+            key = line[:-1]
+            value = {}
+            for child in children:
+                subkey, sep, scalar = child.partition(": ")
+                if not sep or not _is_yaml_key(subkey) or subkey in value:
+                    return None
+                value[subkey] = _load_yaml_scalar(scalar)
+            if None in value.values():
+                return None
+        else:
+            key, sep, scalar = line.partition(": ")
+            if children or not sep:
+                return None
+            value = [] if scalar == "[]" else _load_yaml_scalar(scalar)
+            if value is None:
+                return None
+        if not _is_yaml_key(key) or key in noteDict:
+            return None
+        noteDict[key] = value
+    return noteDict
+
+
+def _encode_chunks(text):
+    for pos in range(0, len(text), _CHUNK_SIZE):
+        yield text[pos:pos + _CHUNK_SIZE].encode("utf-8")
+
+
+def _decode_chunks(chunks):
+    decoder = getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", True)
+
+
+def _b64encode_chunks(chunks):
+    rest = b""
+    for chunk in chunks:
+        chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3
+        rest = chunk[cut:]
+        yield standard_b64encode(chunk[:cut]).decode("ascii")
+    yield standard_b64encode(rest).decode("ascii")
+
 
+def _b64decode_chunks(text):
+    for pos in range(0, len(text), _CHUNK_SIZE):
+        yield standard_b64decode(text[pos:pos + _CHUNK_SIZE])
 
-def _pass2key(password, salt_b):
-    pass_b = bytes(password, "utf-8")
-    return argon2(pass_b, salt_b, 10, 1024, 1, tag_length=32, type_code=ARGON2D)
+
+def _hmac_chunks(hmac, chunks):
+    for chunk in chunks:
+        hmac.update(chunk)
+        yield chunk
 
 
 def is_uuid(name):
@@ -47,27 +181,34 @@ def ulist(iterable):
     return list(items.keys())
 
 
-class _OrderedSafeDumper(SafeDumper):
-    def increase_indent(self, flow=False, indentless=False):
-        return super(_OrderedSafeDumper, self).increase_indent(flow, False)
+def _yaml_dumper():
+    global _OrderedSafeDumper
+    if _OrderedSafeDumper is None:
+        from yaml import SafeDumper
+
+        class _OrderedSafeDumper(SafeDumper):
+            def increase_indent(self, flow=False, indentless=False):
+                return super(_OrderedSafeDumper, self).increase_indent(flow, False)
 
-    @staticmethod
-    def ordered_dict_representer(dumper, data):
-        return dumper.represent_mapping("tag:yaml.org,2002:map", data.items())
+            @staticmethod
+            def ordered_dict_representer(dumper, data):
+                return dumper.represent_mapping("tag:yaml.org,2002:map", data.items())
 
-_OrderedSafeDumper.add_representer(OrderedDict, _OrderedSafeDumper.ordered_dict_representer)
+        _OrderedSafeDumper.add_representer(OrderedDict, _OrderedSafeDumper.ordered_dict_representer)
+    return _OrderedSafeDumper
 
 
 class NoteCrypto(object):
-    def __init__(self, salt, iv, hmac):
+    def __init__(self, salt, iv, hmac, kdf=None):
         self.salt = salt
         self.iv = iv
         self.hmac = hmac
+        self.kdf = kdf
 
     def __eq__(self, that):
         if not isinstance(that, NoteCrypto):
             return False
-        return self.salt == that.salt and self.iv == that.iv and self.hmac == that.hmac
+        return self.salt == that.salt and self.iv == that.iv and self.hmac == that.hmac and self.kdf == that.kdf
 
 
 class NoteType(Enum):
@@ -87,13 +228,14 @@ class NoteStatus(object):
 
 
 class NoteSummary(object):
-    def __init__(self, uuid, date, title, tags, ntype, crypto):
+    def __init__(self, uuid, date, title, tags, ntype, crypto, snippet=None):
         self.uuid = uuid
         self.date = date
         self.title = title
         self.tags = tags
         self.type = ntype
         self.crypto = crypto
+        self.snippet = snippet
 
     def __eq__(self, that):
         if not isinstance(that, NoteSummary):
@@ -121,8 +263,13 @@ class Note(object):
             noteDict["type"] = self.type.value
         if self.crypto:
             cryptoDict = OrderedDict([("salt", self.crypto.salt), ("iv", self.crypto.iv), ("hmac", self.crypto.hmac)])
+            if self.crypto.kdf:
+                cryptoDict["kdf"] = self.crypto.kdf
             noteDict["crypto"] = cryptoDict
-        yaml = dump_all([noteDict], allow_unicode=True, default_flow_style=False, Dumper=_OrderedSafeDumper).strip()
+        yaml = _dump_header(noteDict)
+        if yaml is None:
+            from yaml import dump_all
+            yaml = dump_all([noteDict], allow_unicode=True, default_flow_style=False, Dumper=_yaml_dumper()).strip()
         return self.__HDR_START + yaml + self.__HDR_END + self.text
 
     def __eq__(self, that):
@@ -142,7 +289,11 @@ class Note(object):
             return None
 
         endPos = text.find(cls.__HDR_END)
-        noteDict = safe_load(text[len(cls.__HDR_START):endPos])
+        header = text[len(cls.__HDR_START):endPos]
+        noteDict = _load_header(header)
+        if noteDict is None:
+            from yaml import safe_load
+            noteDict = safe_load(header)
 
         note = Note()
         note.uuid = filename[:32]
@@ -153,27 +304,42 @@ class Note(object):
             note.type = NoteType(noteDict["type"])
         if "crypto" in noteDict:
             cryptoDict = noteDict["crypto"]
-            note.crypto = NoteCrypto(cryptoDict["salt"], cryptoDict["iv"], cryptoDict["hmac"])
+            note.crypto = NoteCrypto(cryptoDict["salt"], cryptoDict["iv"], cryptoDict["hmac"], cryptoDict.get("kdf"))
         note.text = text[endPos + len(cls.__HDR_END):]
         return note
 
+    def __key(self, password):
+        salt = bytes.fromhex(self.crypto.salt)
+        if self.crypto.kdf == SESSION_KDF:
+            keyring = password if isinstance(password, Keyring) else Keyring(password)
+            return keyring.derive(salt[:16], salt[16:])
+        if self.crypto.kdf:
+            raise ValueError("Unsupported key derivation: " + str(self.crypto.kdf))
+        return pass2key(password.password if isinstance(password, Keyring) else password, salt)
+
+    def __is_authentic(self, key):
+        hmac = hmaclib.new(key, bytes.fromhex(self.crypto.iv), "sha256")
+        for chunk in _b64decode_chunks(self.text):
+            hmac.update(chunk)
+        return hmaclib.compare_digest(bytes.fromhex(self.crypto.hmac), hmac.digest())
+
     def encrypt(self, password):
         if self.crypto:
             return False
 
         salt = token_bytes(16)
         iv = token_bytes(16)
-        key = _pass2key(password, salt)
-
-        encrypter = Encrypter(AESModeOfOperationCBC(key, iv))
-        cipher = encrypter.feed(self.text.encode("utf-8"))
-        cipher += encrypter.feed()
+        if isinstance(password, Keyring):
+            key = password.derive(password.salt, salt)
+            salt = password.salt + salt
+        else:
+            key = pass2key(password, salt)
 
         hmac = hmaclib.new(key, iv, "sha256")
-        hmac.update(cipher)
+        cipher = "".join(_b64encode_chunks(_hmac_chunks(hmac, aes_encrypt_stream(key, iv, _encode_chunks(self.text)))))
 
-        cipher = standard_b64encode(cipher).decode("ascii")
-        self.crypto = NoteCrypto(hexlify(salt).decode("ascii"), hexlify(iv).decode("ascii"), hmac.hexdigest())
+        kdf = SESSION_KDF if isinstance(password, Keyring) else None
+        self.crypto = NoteCrypto(hexlify(salt).decode("ascii"), hexlify(iv).decode("ascii"), hmac.hexdigest(), kdf)
         self.text = cipher
         return True
 
@@ -181,19 +347,67 @@ class Note(object):
         if not self.crypto:
             return False
 
-        key = _pass2key(password, bytes.fromhex(self.crypto.salt))
-        iv = bytes.fromhex(self.crypto.iv)
-        cipher = standard_b64decode(self.text)
-        hmac = hmaclib.new(key, iv, "sha256")
-        hmac.update(cipher)
-        if not hmaclib.compare_digest(bytes.fromhex(self.crypto.hmac), hmac.digest()):
+        key = self.__key(password)
+        if not self.__is_authentic(key):
             return False
 
-        decrypter = Decrypter(AESModeOfOperationCBC(key, iv))
-        text = decrypter.feed(cipher)
-        text += decrypter.feed()
-        text = text.decode("utf-8")
+        iv = bytes.fromhex(self.crypto.iv)
+        text = "".join(_decode_chunks(aes_decrypt_stream(key, iv, _b64decode_chunks(self.text))))
 
         self.crypto = None
         self.text = text
         return True
+
+    def verify(self, password):
+        if not self.crypto:
+            return False
+
+        salt = bytes.fromhex(self.crypto.salt)
+        if self.crypto.kdf == SESSION_KDF:
+            salt = salt[:16]
+        passphrase = password.password if isinstance(password, Keyring) else password
+        if verified_cache.get(passphrase, salt) is not None:
+            return True
+        if not self.__is_authentic(self.__key(password)):
+            return False
+        verified_cache.put(passphrase, salt, b"")
+        return True
+
+
+def _decrypt_note(note, password):
+    success = note.decrypt(password)
+    return note.crypto, note.text, success
+
+
+def _encrypt_note(note, password):
+    success = note.encrypt(password)
+    return note.crypto, note.text, success
+
+
+def _crypt_many(func, notes, password, workers):
+    notes = list(notes)
+    if workers and len(notes) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(func, notes, repeat(password), chunksize=max(1, len(notes) // (4 * workers))))
+    else:
+        results = [func(note, password) for note in notes]
+
+    flags = []
+    for (note, (crypto, text, success)) in zip(notes, results):
+        note.crypto = crypto
+        note.text = text
+        flags.append(success)
+    return flags
+
+
+def decrypt_many(notes, password, workers=None):
+    return _crypt_many(_decrypt_note, notes, password, workers)
+
+
+def encrypt_many(notes, password, workers=None):
+    return _crypt_many(_encrypt_note, notes, password, workers)
+
+
+def verify_password(notes, password):
+    return [note.verify(password) for note in notes]
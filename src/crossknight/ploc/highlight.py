@@ -0,0 +1,38 @@
+# coding:utf-8
+from crossknight.ploc import markdown
+from crossknight.ploc.markdown import content_hash
+from crossknight.ploc.markdown import get_lexer
+from crossknight.ploc.markdown import highlight_cache
+from functools import lru_cache
+from mistune import Renderer
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+
+
+_CLASS_PREFIX = "pygm-"
+_STYLE = "default"
+_STYLE_SELECTOR = "pre"
+_formatter = HtmlFormatter(classprefix=_CLASS_PREFIX, nowrap=True)
+
+
+@lru_cache(maxsize=None)
+def stylesheet(style=_STYLE, selector=_STYLE_SELECTOR):
+    return HtmlFormatter(style=style, classprefix=_CLASS_PREFIX).get_style_defs(selector)
+
+
+class HighlightRenderer(Renderer):
+    def block_code(self, code, lang=None):
+        key = (lang, content_hash(code), markdown.max_code_size, markdown.guess_fallback)
+        html = highlight_cache.get(key)
+        if html is None:
+            html = self.__highlight(code, lang)
+            highlight_cache.put(key, html)
+        return html
+
+    def __highlight(self, code, lang):
+        lexer = get_lexer(code, lang) if len(code) <= markdown.max_code_size else None
+        if lexer:
+            language = lexer.name.lower().replace(" ", "")
+            return '<pre><code class="language-%s">%s</code></pre>\n' % (language, highlight(code, lexer, _formatter))
+        else:
+            return super().block_code(code, lang)
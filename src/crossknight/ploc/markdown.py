@@ -1,49 +1,271 @@
 # coding:utf-8
-from mistune import markdown
-from mistune import Renderer
-from pygments import highlight
-from pygments.formatters.html import HtmlFormatter
-from pygments.lexers import get_lexer_by_name
-from pygments.lexers import guess_lexer
-from pygments.util import ClassNotFound
+from crossknight.ploc.parallel import imap
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from hashlib import sha256
+from html import escape
+from itertools import islice
+from re import compile
+from threading import local
+from threading import Lock
 
 
-def _get_lexer(code, lang):
-    if lang:
-        try:
-            return get_lexer_by_name(lang, stripall=True)
-        except ClassNotFound:
-            pass
+_RENDER_CACHE_SIZE = 256
+_HIGHLIGHT_CACHE_SIZE = 1024
+_LEXER_CACHE_SIZE = 64
+_RENDER_CHUNK_SIZE = 32
+_GUESS_LENGTH = 4096
+_GUESS_LANGUAGES = ("bash", "python", "javascript", "html", "xml", "css", "sql", "json", "yaml", "diff", "c", "cpp",
+                    "java", "php", "ini")
+_GUESS_HINTS = (
+    ("json", 0.5, compile(r'\A\s*[\[{]\s*["\[{\d\]}]')),
+    ("python", 0.5, compile(r"(?m)^(?:def \w+\(|class \w+[(:]|from [\w.]+ import |import \w+\s*$)")),
+    ("javascript", 0.4, compile(r"(?m)^\s*(?:const|let|var|function|export)\s|=>|\bconsole\.")),
+    ("sql", 0.4, compile(r"(?i)\A\s*(?:select|insert|update|delete|create|alter|drop|with)\s")),
+    ("css", 0.3, compile(r"\A\s*[\w.#:*\[\]=-]+(?:\s*,\s*[\w.#:*\[\]=-]+)*\s*\{\s*[\w-]+\s*:")),
+    ("yaml", 0.2, compile(r"\A(?:---\s*\n)?[\w-]+:(?:\s|$)")),
+)
+_DEFINITION = compile(r"(?m)^ {0,3}\[[^\]]+\]:")
+_OPEN_ENDED_BLOCKS = ("block_html", "nptable", "table")
+_pool = None
+_pool_lock = Lock()
+guess_fallback = "text"
+max_input_size = 1 << 20
+max_code_size = 1 << 16
+render_timeout = None
+
+
+class _LruCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+
+render_cache = _LruCache(_RENDER_CACHE_SIZE)
+highlight_cache = _LruCache(_HIGHLIGHT_CACHE_SIZE)
+
+
+@lru_cache(maxsize=_LEXER_CACHE_SIZE)
+def _lexer_by_name(name):
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
     try:
-        return guess_lexer(code, stripall=True)
+        return get_lexer_by_name(name, stripall=True)
     except ClassNotFound:
         return None
 
 
+def _guess_lexer(code):
+    sample = code[:_GUESS_LENGTH]
+    scores = {}
+    for (name, score, hint) in _GUESS_HINTS:
+        if hint.search(sample):
+            scores[name] = score
+    best = None
+    bestScore = 0.0
+    for name in _GUESS_LANGUAGES:
+        lexer = _lexer_by_name(name)
+        score = max(lexer.analyse_text(sample), scores.get(name, 0.0)) if lexer else 0.0
+        if score > bestScore:
+            best = lexer
+            bestScore = score
+            if score >= 1.0:
+                break
+    return best or (_lexer_by_name(guess_fallback) if guess_fallback else None)
+
+
+def get_lexer(code, lang):
+    return lang and _lexer_by_name(lang) or _guess_lexer(code)
+
+
+def content_hash(text):
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def render_digest(text):
+    return content_hash("%d:%d:%s\n" % (max_input_size, max_code_size, guess_fallback) + text)
+
+
 def render(text):
-    return markdown(text, escape=False, renderer=_Renderer())
+    return render_exact(text)[0]
+
+
+def render_exact(text):
+    digest = render_digest(text)
+    html = render_cache.get(digest)
+    if html is not None:
+        return html, True
+    html, exact = _render_bounded(text)
+    if exact:
+        render_cache.put(digest, html)
+    return html, exact
+
 
+def _render_plain(text):
+    return "<pre>" + escape(text, False) + "</pre>\n"
 
-class _Renderer(Renderer):
-    def block_code(self, code, lang=None):
-        lexer = _get_lexer(code, lang)
-        if lexer:
-            return highlight(code, lexer, _HtmlFormatter(language=lexer.name, classprefix="pygm-"))
+
+def _render_limited(text, codeSize, fallback):
+    global max_code_size
+    global guess_fallback
+    max_code_size = codeSize
+    guess_fallback = fallback
+    return _renderer.render(text)
+
+
+def _render_in_worker(text):
+    global _pool
+    from multiprocessing import get_context
+    from multiprocessing import TimeoutError
+    with _pool_lock:
+        if _pool is None:
+            _pool = get_context("spawn").Pool(1)
+        pool = _pool
+    result = pool.apply_async(_render_limited, (text, max_code_size, guess_fallback))
+    try:
+        return result.get(render_timeout), True
+    except TimeoutError:
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        pool.terminate()
+        return _render_plain(text), False
+
+
+def _render_bounded(text):
+    if len(text) > max_input_size:
+        return _render_plain(text), False
+    if render_timeout:
+        return _render_in_worker(text)
+    return _renderer.render(text), True
+
+
+def _split_blocks(text):
+    from mistune import BlockGrammar
+    from mistune import BlockLexer
+    from mistune import preprocessing
+    text = preprocessing(text).rstrip("\n")
+    if _DEFINITION.search(text):
+        return [text] if text else []
+    rules = [(key, getattr(BlockGrammar, key)) for key in BlockLexer.default_rules]
+    blocks = []
+    block = ""
+    while text:
+        for (key, rule) in rules:
+            match = rule.match(text)
+            if match:
+                break
+        size = len(match.group(0)) if match else len(text)
+        block += text[:size]
+        text = text[size:]
+        if not text or block.endswith("\n\n") and key not in _OPEN_ENDED_BLOCKS:
+            if block.strip("\n"):
+                blocks.append(block.rstrip("\n"))
+            block = ""
+    return blocks
+
+
+def _note_texts(texts_or_notes):
+    for item in texts_or_notes:
+        if isinstance(item, str):
+            yield item
         else:
-            return super().block_code(code, lang)
+            yield None if item.crypto else item.text
+
+
+def _render_all(texts):
+    return [None if text is None else render(text) for text in texts]
+
+
+def iter_render(texts_or_notes, workers=None, chunk_size=_RENDER_CHUNK_SIZE):
+    texts = _note_texts(texts_or_notes)
+    batches = iter(lambda: list(islice(texts, chunk_size)), [])
+    if not workers:
+        for batch in batches:
+            yield from _render_all(batch)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as executor:
+        for htmls in imap(executor, _render_all, batches, 2 * workers):
+            yield from htmls
+
+
+def render_many(texts_or_notes, workers=None, chunk_size=_RENDER_CHUNK_SIZE):
+    return list(iter_render(texts_or_notes, workers, chunk_size))
+
+
+class MarkdownRenderer(object):
+    def __init__(self):
+        self.__local = local()
+
+    def __markdown(self):
+        if not hasattr(self.__local, "markdown"):
+            from crossknight.ploc.highlight import HighlightRenderer
+            from mistune import Markdown
+            self.__local.markdown = Markdown(escape=False, renderer=HighlightRenderer())
+        return self.__local.markdown
+
+    def render(self, text):
+        try:
+            return self.__markdown().parse(text)
+        except BaseException:
+            del self.__local.markdown
+            raise
+
 
+class IncrementalRenderer(object):
+    def __init__(self):
+        self.blocks = []
+        self.__digests = []
+        self.__htmls = {}
 
-class _HtmlFormatter(HtmlFormatter):
-    def __init__(self, language, **options):
-        super().__init__(**options)
-        self.language = language.lower().replace(" ", "")
+    def render(self, text):
+        blocks = _split_blocks(text)
+        digests = [render_digest(block) for block in blocks]
+        htmls = {}
+        fallbacks = set()
+        for (digest, block) in zip(digests, blocks):
+            if digest in htmls:
+                continue
+            if digest in self.__htmls:
+                htmls[digest] = self.__htmls[digest]
+            else:
+                htmls[digest], exact = _render_bounded(block)
+                if not exact:
+                    fallbacks.add(digest)
+        changed = []
+        for (tag, _, _, start, end) in SequenceMatcher(None, self.__digests, digests, False).get_opcodes():
+            if tag != "equal":
+                changed.append((start, end))
+        self.blocks = [htmls[digest] for digest in digests]
+        self.__digests = [None if digest in fallbacks else digest for digest in digests]
+        self.__htmls = {digest: html for (digest, html) in htmls.items() if digest not in fallbacks}
+        return "".join(self.blocks), changed
 
-    def _wrap_div(self, inner):
-        for tup in inner:
-            yield tup
 
-    def _wrap_pre(self, inner):
-        yield 0, '<pre><code class="language-%s">' % self.language
-        for tup in inner:
-            yield tup
-        yield 0, "</code></pre>\n"
+_renderer = MarkdownRenderer()
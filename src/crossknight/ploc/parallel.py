@@ -0,0 +1,12 @@
+# coding:utf-8
+from collections import deque
+
+
+def imap(executor, func, iterable, window):
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
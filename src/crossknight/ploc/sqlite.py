@@ -6,25 +6,74 @@ from crossknight.ploc.domain import NoteStatus
 from crossknight.ploc.domain import NoteSummary
 from crossknight.ploc.domain import NoteType
 from crossknight.ploc.domain import ulist
+from crossknight.ploc.markdown import iter_render
+from crossknight.ploc.markdown import render
+from crossknight.ploc.markdown import render_digest
+from crossknight.ploc.markdown import render_exact
+from crossknight.ploc.parallel import imap
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from contextlib import nullcontext
 from datetime import datetime
 from datetime import timedelta
+from html import escape
+from itertools import tee
+from os.path import join
+from peewee import AutoField
+from peewee import Case
 from peewee import CharField
+from peewee import chunked
 from peewee import DateTimeField
 from peewee import FixedCharField
+from peewee import fn
 from peewee import ForeignKeyField
-from peewee import IntegrityError
 from peewee import Model
 from peewee import SqliteDatabase
 from peewee import TextField
+from peewee import Tuple
+from unicodedata import combining
+from unicodedata import normalize
+from playhouse.migrate import migrate
+from playhouse.migrate import SqliteMigrator
+from playhouse.sqlite_ext import FTS5Model
+from playhouse.sqlite_ext import SearchField
+from secrets import token_hex
+from sqlite3 import sqlite_version
+from sqlite3 import sqlite_version_info
+from zipfile import BadZipFile
 from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
 from zipfile import ZipFile
 from zipfile import ZipInfo
 
 
 _DB_FILENAME = "ploc.db"
-_ACCENTED_CHARS_TRANSLATION = str.maketrans({"á": "a", "é": "e", "í": "i", "ó": "o", "ú": "u"})
-
-
+_SQLITE_MIN_VERSION = (3, 34, 0)
+_SCHEMA_VERSION = 3
+_PAGE_SIZE = 50
+_BATCH_SIZE = 500
+_CONFLICT_ACTIONS = ("abort", "ignore", "replace")
+_SEARCH_MIN_LENGTH = 3
+_SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+_SNIPPET_SENTINEL = "\x02%s\x03"
+_MARK_START = "<mark>"
+_MARK_END = "</mark>"
+_SNIPPET_ELLIPSIS = "…"
+_SNIPPET_TOKENS = 64
+_SEARCH_SOURCE_VIEW = "CREATE VIEW IF NOT EXISTS note_search_source AS " \
+                      "SELECT i.id AS id, n.title AS title, n.tags AS tags, " \
+                      "CASE WHEN n.crypto IS NULL THEN n.text ELSE '' END AS text " \
+                      "FROM note_index i JOIN note n ON n.uuid = i.uuid"
+
+
+class _FoldingTable(dict):
+    def __missing__(self, code):
+        folded = "".join(c for c in normalize("NFKD", chr(code)) if not combining(c)).lower()
+        self[code] = folded if len(folded) == 1 else chr(code)
+        return self[code]
+
+
+_FOLDING_TABLE = _FoldingTable()
 _db = SqliteDatabase(_DB_FILENAME, pragmas={
     "journal_mode": "wal",
     "foreign_keys": 1,
@@ -32,8 +81,40 @@ _db = SqliteDatabase(_DB_FILENAME, pragmas={
 })
 
 
+_archive = None
+
+
+def _open_archive(filepath):
+    global _archive
+    _archive = ZipFile(filepath)
+
+
+def _is_valid_note(note):
+    return isinstance(note.title, str) and all(isinstance(tag, str) for tag in note.tags)
+
+
+def _read_note(zipped, filename):
+    fileinfo = zipped.getinfo(filename)
+    with zipped.open(fileinfo) as notefile:
+        note = Note.from_text(filename, datetime(*fileinfo.date_time), notefile.read())
+    return note if note and _is_valid_note(note) else None
+
+
+def _read_notes(filenames, zipped=None):
+    from yaml import YAMLError
+    zipped = zipped or _archive
+    notes = []
+    for filename in filenames:
+        try:
+            notes.append(_read_note(zipped, filename))
+        except (AttributeError, BadZipFile, KeyError, TypeError, ValueError, YAMLError):
+            notes.append(None)
+    return notes
+
+
+@_db.func("comparable", 1)
 def _comparable(txt):
-    return txt.lower().translate(_ACCENTED_CHARS_TRANSLATION)
+    return txt.translate(_FOLDING_TABLE)
 
 
 class _BaseModel(Model):
@@ -44,9 +125,11 @@ class _BaseModel(Model):
 class _Note(_BaseModel):
     class Meta:
         table_name = "note"
+        indexes = ((("title_key", "uuid"), False),)
     uuid = FixedCharField(primary_key=True, max_length=32)
     date = DateTimeField()
     title = CharField()
+    title_key = CharField()
     tags = TextField(null=True)
     type = CharField(index=True)
     crypto = CharField(null=True)
@@ -57,9 +140,10 @@ class _NoteTag(_BaseModel):
     class Meta:
         table_name = "note_tag"
         primary_key = False
-        indexes = ((("uuid", "name"), True),)
+        indexes = ((("uuid", "name"), True), (("name_key", "name"), False))
     uuid = ForeignKeyField(_Note, on_delete="CASCADE", index=True)
     name = CharField(index=True)
+    name_key = CharField()
 
 
 class _RemovedNote(_BaseModel):
@@ -69,20 +153,71 @@ class _RemovedNote(_BaseModel):
     date = DateTimeField()
 
 
+class _NoteIndex(_BaseModel):
+    class Meta:
+        table_name = "note_index"
+    id = AutoField()
+    uuid = FixedCharField(unique=True, max_length=32)
+
+
+class _NoteSearch(FTS5Model):
+    class Meta:
+        database = _db
+        table_name = "note_search"
+        options = {"content": "note_search_source", "content_rowid": "id", "tokenize": "trigram"}
+    title = SearchField()
+    tags = SearchField()
+    text = SearchField()
+
+
+class _RenderedNote(_BaseModel):
+    class Meta:
+        table_name = "rendered_html"
+    uuid = ForeignKeyField(_Note, primary_key=True, on_delete="CASCADE")
+    digest = FixedCharField(max_length=64)
+    html = TextField()
+
+
+_SUMMARY_COLUMNS = (_Note.uuid, _Note.date, _Note.title, _Note.tags, _Note.type, _Note.crypto)
+
+
 class Provider(object):
-    def __init__(self):
+    def __init__(self, persist_html=False):
+        if sqlite_version_info < _SQLITE_MIN_VERSION:
+            raise RuntimeError("SQLite %s or later is required for the trigram search index, found %s" %
+                               (".".join(map(str, _SQLITE_MIN_VERSION)), sqlite_version))
         self.filename = _DB_FILENAME
-        _db.create_tables([_Note, _NoteTag, _RemovedNote])
+        self.persist_html = persist_html
+        with _db.atomic():
+            self.__add_missing_columns()
+            _db.create_tables([_Note, _NoteTag, _RemovedNote, _NoteIndex, _NoteSearch, _RenderedNote])
+            _db.execute_sql(_SEARCH_SOURCE_VIEW)
+            if _db.pragma("user_version") != _SCHEMA_VERSION:
+                self.__reindex()
+                _db.pragma("user_version", _SCHEMA_VERSION)
+
+    @classmethod
+    def __add_missing_columns(cls):
+        migrator = SqliteMigrator(_db)
+        for model in (_Note, _NoteTag):
+            if model.table_exists():
+                table = model._meta.table_name
+                columns = [c.name for c in _db.get_columns(table)]
+                for field in model._meta.sorted_fields:
+                    if field.column_name not in columns:
+                        migrate(migrator.alter_add_column(table, field.column_name, type(field)()))
 
     @classmethod
     def __note2models(cls, note):
         tags = None if not note.tags else "\n".join(note.tags)
         crypto = None if not note.crypto else note.crypto.salt + note.crypto.iv + note.crypto.hmac
-        noteModel = _Note(uuid=note.uuid, date=note.date, title=note.title, tags=tags, type=note.type.value,
-                          crypto=crypto, text=note.text)
+        if note.crypto and note.crypto.kdf:
+            crypto = note.crypto.kdf + ":" + crypto
+        noteModel = _Note(uuid=note.uuid, date=note.date, title=note.title, title_key=_comparable(note.title),
+                          tags=tags, type=note.type.value, crypto=crypto, text=note.text)
         tagModels = []
         for tag in note.tags:
-            tagModels.append(_NoteTag(uuid=note.uuid, name=tag))
+            tagModels.append(_NoteTag(uuid=note.uuid, name=tag, name_key=_comparable(tag)))
         return noteModel, tagModels
 
     @classmethod
@@ -97,13 +232,56 @@ class Provider(object):
         note.text = model.text
         return note
 
+    @classmethod
+    def __index(cls, noteModels):
+        uuids = [m.uuid for m in noteModels]
+        _NoteIndex.insert_many([{"uuid": uuid} for uuid in uuids]).execute()
+        docids = dict(_NoteIndex.select(_NoteIndex.uuid, _NoteIndex.id).where(_NoteIndex.uuid.in_(uuids)).tuples())
+        rows = []
+        for model in noteModels:
+            rows.append({"rowid": docids[model.uuid], "title": _comparable(model.title),
+                         "tags": _comparable(model.tags or ""),
+                         "text": "" if model.crypto else _comparable(model.text)})
+        _NoteSearch.insert_many(rows).execute()
+
+    @classmethod
+    def __unindex(cls, uuids):
+        query = _Note.select(_NoteIndex.id, _Note.title, _Note.tags, _Note.crypto, _Note.text)\
+            .join(_NoteIndex, on=(_NoteIndex.uuid == _Note.uuid)).where(_Note.uuid.in_(uuids))
+        for (docid, title, tags, crypto, text) in query.tuples():
+            # noinspection PyProtectedMember
+            _NoteSearch._fts_cmd("delete", rowid=docid, title=_comparable(title), tags=_comparable(tags or ""),
+                                 text="" if crypto else _comparable(text))
+        _NoteIndex.delete().where(_NoteIndex.uuid.in_(uuids)).execute()
+
+    @classmethod
+    def __reindex(cls):
+        _Note.update(title_key=fn.comparable(_Note.title)).execute()
+        _NoteTag.update(name_key=fn.comparable(_NoteTag.name)).execute()
+        _NoteSearch.delete_all()
+        _NoteIndex.delete().execute()
+        _NoteIndex.insert_from(_Note.select(_Note.uuid), [_NoteIndex.uuid]).execute()
+        source = _NoteIndex.select(_NoteIndex.id, fn.comparable(_Note.title),
+                                   fn.comparable(fn.coalesce(_Note.tags, "")),
+                                   Case(None, [(_Note.crypto.is_null(), fn.comparable(_Note.text))], ""))\
+            .join(_Note, on=(_Note.uuid == _NoteIndex.uuid))
+        _NoteSearch.insert_from(source, [_NoteSearch.rowid, _NoteSearch.title, _NoteSearch.tags, _NoteSearch.text])\
+            .execute()
+
+    @classmethod
+    def __search_phrase(cls, text):
+        return '"' + _comparable(text).replace('"', '""') + '"'
+
     @classmethod
     def __unpack_tags(cls, text):
         return text.split("\n") if text else []
 
     @classmethod
     def __unpack_crypto(cls, text):
-        return NoteCrypto(text[:32], text[32:64], text[64:]) if text else None
+        if not text:
+            return None
+        kdf, _, text = text.rpartition(":")
+        return NoteCrypto(text[:-96], text[-96:-64], text[-64:], kdf or None)
 
     @classmethod
     def __localtimetuple(cls, ndate):
@@ -117,52 +295,179 @@ class Provider(object):
         return len(filename) == 35 and filename.endswith(".md") and is_uuid(filename[:32])
 
     @classmethod
-    def list(cls, tags=None, ntype=None, text=None):
-        query = _Note.select(_Note.uuid, _Note.date, _Note.title, _Note.tags, _Note.type, _Note.crypto)
+    def __is_searchable(cls, text):
+        return text and len(_comparable(text)) >= _SEARCH_MIN_LENGTH
+
+    @classmethod
+    def __filters(cls, tags, ntype, text):
         andFilters = []
         if tags:
             subquery = _NoteTag.select(_NoteTag.uuid).where(_NoteTag.name.in_(tags)).distinct()
             andFilters.append(_Note.uuid.in_(subquery))
         if ntype:
             andFilters.append(_Note.type == ntype.value)
-        if text:
+        if cls.__is_searchable(text):
+            subquery = _NoteSearch.select(_NoteIndex.uuid).join(_NoteIndex, on=(_NoteIndex.id == _NoteSearch.rowid))\
+                .where(_NoteSearch.match(cls.__search_phrase(text)))
+            andFilters.append(_Note.uuid.in_(subquery))
+        elif text:
             andFilters.append(_Note.title.contains(text) | _Note.tags.contains(text) |
                               (_Note.crypto.is_null() & _Note.text.contains(text)))
+        return andFilters
+
+    @classmethod
+    def __summary(cls, uuid, ndate, title, tags, ntype, crypto, snippet=None):
+        return NoteSummary(uuid, ndate, title, cls.__unpack_tags(tags), NoteType(ntype), cls.__unpack_crypto(crypto),
+                           snippet)
+
+    @classmethod
+    def __pack_cursor(cls, titleKey, uuid):
+        return urlsafe_b64encode((titleKey + uuid).encode("utf-8")).decode("ascii")
+
+    @classmethod
+    def __unpack_cursor(cls, cursor):
+        text = urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        return text[:-32], text[-32:]
+
+    @classmethod
+    def list(cls, tags=None, ntype=None, text=None, ranked=False):
+        return list(cls.iter_list(tags, ntype, text, ranked))
+
+    @classmethod
+    def iter_list(cls, tags=None, ntype=None, text=None, ranked=False):
+        if ranked and cls.__is_searchable(text):
+            yield from cls.__search(tags, ntype, text)
+            return
+        query = _Note.select(*_SUMMARY_COLUMNS)
+        andFilters = cls.__filters(tags, ntype, text)
         if andFilters:
             query = query.where(*tuple(andFilters))
+        query = query.order_by(_Note.title_key, _Note.uuid)
 
-        summaries = []
-        for (uuid, ndate, title, tags, ntype, crypto) in query.tuples():
-            tags = cls.__unpack_tags(tags)
-            crypto = cls.__unpack_crypto(crypto)
-            summaries.append(NoteSummary(uuid, ndate, title, tags, NoteType(ntype), crypto))
-        summaries.sort(key=lambda s: _comparable(s.title))
-        return summaries
+        for row in query.tuples().iterator():
+            yield cls.__summary(*row)
+
+    @classmethod
+    def list_page(cls, cursor=None, limit=_PAGE_SIZE, tags=None, ntype=None, text=None):
+        if limit < 1:
+            raise ValueError("Invalid page limit: " + str(limit))
+        query = _Note.select(_Note.title_key, *_SUMMARY_COLUMNS)
+        andFilters = cls.__filters(tags, ntype, text)
+        if cursor:
+            andFilters.append(Tuple(_Note.title_key, _Note.uuid) > Tuple(*cls.__unpack_cursor(cursor)))
+        if andFilters:
+            query = query.where(*tuple(andFilters))
+        query = query.order_by(_Note.title_key, _Note.uuid).limit(limit + 1)
+
+        rows = list(query.tuples())
+        nextCursor = cls.__pack_cursor(rows[limit - 1][0], rows[limit - 1][1]) if len(rows) > limit else None
+        return [cls.__summary(*row[1:]) for row in rows[:limit]], nextCursor
+
+    @classmethod
+    def __search(cls, tags, ntype, text):
+        start = _SNIPPET_SENTINEL % token_hex(8)
+        end = _SNIPPET_SENTINEL % token_hex(8)
+        snippet = fn.snippet(_NoteSearch._meta.entity, 2, start, end, _SNIPPET_ELLIPSIS, _SNIPPET_TOKENS)
+        query = _NoteSearch.select(*_SUMMARY_COLUMNS, snippet)\
+            .join(_NoteIndex, on=(_NoteIndex.id == _NoteSearch.rowid))\
+            .join(_Note, on=(_Note.uuid == _NoteIndex.uuid))\
+            .where(_NoteSearch.match(cls.__search_phrase(text)), *tuple(cls.__filters(tags, ntype, None)))\
+            .order_by(_NoteSearch.bm25(*_SEARCH_WEIGHTS))
+
+        for row in query.tuples().iterator():
+            yield cls.__summary(*row[:-1], snippet=cls.__mark(row[-1], start, end) or None)
+
+    @classmethod
+    def __mark(cls, snippet, start, end):
+        if not snippet:
+            return snippet
+        return escape(snippet).replace(start, _MARK_START).replace(end, _MARK_END)
 
     # noinspection PyMethodMayBeStatic
     def tags(self):
-        return sorted(map(lambda t: t[0], _NoteTag.select(_NoteTag.name).distinct().tuples()), key=_comparable)
+        query = _NoteTag.select(_NoteTag.name_key, _NoteTag.name).distinct().order_by(_NoteTag.name_key, _NoteTag.name)
+        return [t[1] for t in query.tuples()]
 
     def get(self, uuid):
         return self.__model2note(_Note.get_by_id(uuid))
 
+    def render_html(self, uuid):
+        crypto, text = _Note.select(_Note.crypto, _Note.text).where(_Note.uuid == uuid).tuples().get()
+        if crypto:
+            return None
+        if not self.persist_html:
+            return render(text)
+        digest = render_digest(text)
+        query = _RenderedNote.select(_RenderedNote.html)\
+            .where((_RenderedNote.uuid == uuid) & (_RenderedNote.digest == digest))
+        for (html,) in query.tuples():
+            return html
+        html, exact = render_exact(text)
+        if exact:
+            _RenderedNote.insert(uuid=uuid, digest=digest, html=html).on_conflict_replace().execute()
+        return html
+
     @_db.atomic()
     def add(self, note):
         noteModel, tagModels = self.__note2models(note)
         noteModel.save(force_insert=True)
         for model in tagModels:
             model.save(force_insert=True)
+        self.__index([noteModel])
+
+    @_db.atomic()
+    def add_many(self, notes, on_conflict="abort"):
+        if on_conflict not in _CONFLICT_ACTIONS:
+            raise ValueError("Unknown conflict action: " + str(on_conflict))
+        results = []
+        for chunk in chunked(notes, _BATCH_SIZE):
+            flags = [True] * len(chunk) if on_conflict == "abort" else self.__fresh_flags(chunk)
+            self.__insert_many([n for (n, fresh) in zip(chunk, flags) if fresh])
+            if on_conflict == "replace":
+                for note in [n for (n, fresh) in zip(chunk, flags) if not fresh]:
+                    self.update(note)
+            results.extend(fresh or on_conflict == "replace" for fresh in flags)
+        return results
+
+    @classmethod
+    def __fresh_flags(cls, notes):
+        seen = {t[0] for t in _Note.select(_Note.uuid).where(_Note.uuid.in_([n.uuid for n in notes])).tuples()}
+        flags = []
+        for note in notes:
+            flags.append(note.uuid not in seen)
+            seen.add(note.uuid)
+        return flags
+
+    @classmethod
+    def __insert_many(cls, notes):
+        if not notes:
+            return
+        noteModels = []
+        tagModels = []
+        for note in notes:
+            noteModel, models = cls.__note2models(note)
+            noteModels.append(noteModel)
+            tagModels.extend(models)
+        _Note.insert_many([m.__data__ for m in noteModels]).execute()
+        for batch in chunked(tagModels, _BATCH_SIZE):
+            _NoteTag.insert_many([m.__data__ for m in batch]).execute()
+        cls.__index(noteModels)
 
     @_db.atomic()
     def update(self, note):
         noteModel, tagModels = self.__note2models(note)
-        noteModel.save()
+        self.__unindex([note.uuid])
+        _RenderedNote.delete().where(_RenderedNote.uuid == note.uuid).execute()
+        if noteModel.save():
+            self.__index([noteModel])
         _NoteTag.delete().where(_NoteTag.uuid == note.uuid).execute()
         for model in tagModels:
             model.save(force_insert=True)
 
     @_db.atomic()
     def remove(self, uuid, ndate=None):
+        self.__unindex([uuid])
+        _RenderedNote.delete().where(_RenderedNote.uuid == uuid).execute()
         _Note.delete().where(_Note.uuid == uuid).execute()
         _RemovedNote(uuid=uuid, date=ndate or datetime.now()).save(force_insert=True)
 
@@ -171,6 +476,7 @@ class Provider(object):
         uuids = [t[0] for t in _NoteTag.select(_NoteTag.uuid).where(_NoteTag.name == tag).distinct().tuples()]
         if uuids:
             ndate = datetime.now()
+            self.__unindex(uuids)
             for uuid in uuids:
                 tags = _Note.select(_Note.tags).where(_Note.uuid == uuid).tuples().get()[0].split("\n")
                 pos = tags.index(tag)
@@ -185,46 +491,78 @@ class Provider(object):
                 tags = []
                 for tag in newTags:
                     for uuid in uuids:
-                        tags.append({"uuid": uuid, "name": tag})
+                        tags.append({"uuid": uuid, "name": tag, "name_key": _comparable(tag)})
                 _NoteTag.insert_many(tags).on_conflict_ignore().execute()
+            self.__index(list(_Note.select().where(_Note.uuid.in_(uuids))))
 
-    def export(self, uuids, filepath):
-        with ZipFile(filepath, "w", ZIP_DEFLATED) as zipped:
-            for uuid in uuids:
-                note = self.get(uuid)
-                fileinfo = ZipInfo(uuid + ".md", self.__localtimetuple(note.date))
-                zipped.writestr(fileinfo, str(note).encode("utf-8"))
-
-    def import_from(self, filepath):
+    @classmethod
+    def __iter_notes(cls, uuids):
+        for batch in chunked(uuids, _BATCH_SIZE):
+            models = {m.uuid: m for m in _Note.select().where(_Note.uuid.in_(batch))}
+            for uuid in batch:
+                if uuid not in models:
+                    raise _Note.DoesNotExist("Note not found: " + uuid)
+                yield cls.__model2note(models[uuid])
+
+    def export(self, uuids, filepath, compresslevel=None, store_encrypted=False):
+        with ZipFile(filepath, "w", ZIP_DEFLATED, compresslevel=compresslevel) as zipped:
+            for note in self.__iter_notes(uuids):
+                fileinfo = ZipInfo(note.uuid + ".md", self.__localtimetuple(note.date))
+                fileinfo.compress_type = ZIP_STORED if store_encrypted and note.crypto else ZIP_DEFLATED
+                zipped.writestr(fileinfo, str(note).encode("utf-8"), compresslevel=compresslevel)
+
+    def export_html(self, uuids, dirpath, workers=None):
+        notes, pending = tee(self.__iter_notes(uuids))
+        exported = 0
+        for (note, html) in zip(pending, iter_render(notes, workers)):
+            if html is not None:
+                with open(join(dirpath, note.uuid + ".html"), "w", encoding="utf-8") as file:
+                    file.write(html)
+                exported += 1
+        return exported
+
+    def import_from(self, filepath, chunk_size=None, workers=None):
         imported = 0
         duplicated = 0
         corrupted = 0
         with ZipFile(filepath) as zipped:
-            for fileinfo in filter(lambda i: self.__is_note_file(i.filename), zipped.infolist()):
-                ndate = datetime(*fileinfo.date_time)
-                with zipped.open(fileinfo) as notefile:
-                    note = Note.from_text(fileinfo.filename, ndate, notefile.read())
-                if note:
-                    try:
-                        self.add(note)
-                        imported += 1
-                    except IntegrityError:
-                        duplicated += 1
+            filenames = [i.filename for i in zipped.infolist() if self.__is_note_file(i.filename)]
+            batches = chunked(filenames, chunk_size or _BATCH_SIZE)
+            executor = None
+            if workers:
+                from concurrent.futures import ProcessPoolExecutor
+                executor = ProcessPoolExecutor(workers, initializer=_open_archive, initargs=(filepath,))
+            with executor or nullcontext():
+                if executor:
+                    results = imap(executor, _read_notes, batches, 2 * workers)
                 else:
-                    corrupted += 1
+                    results = (_read_notes(batch, zipped) for batch in batches)
+                with nullcontext() if chunk_size else _db.atomic():
+                    for notes in results:
+                        valid = [n for n in notes if n]
+                        added = sum(self.add_many(valid, on_conflict="ignore"))
+                        imported += added
+                        duplicated += len(valid) - added
+                        corrupted += len(notes) - len(valid)
         return imported, duplicated, corrupted
 
-    # noinspection PyMethodMayBeStatic
     def state(self):
-        result = {}
-        for (uuid, ndate) in _RemovedNote.select(_RemovedNote.uuid, _RemovedNote.date).tuples():
-            result[uuid] = NoteStatus(uuid, ndate, False)
-        for (uuid, ndate) in _Note.select(_Note.uuid, _Note.date).tuples():
-            result[uuid] = NoteStatus(uuid, ndate, True)
-        return result
+        return {status.uuid: status for status in self.iter_state()}
+
+    # noinspection PyMethodMayBeStatic
+    def iter_state(self):
+        query = _RemovedNote.select(_RemovedNote.uuid, _RemovedNote.date)\
+            .where(_RemovedNote.uuid.not_in(_Note.select(_Note.uuid)))
+        for (uuid, ndate) in query.tuples().iterator():
+            yield NoteStatus(uuid, ndate, False)
+        for (uuid, ndate) in _Note.select(_Note.uuid, _Note.date).tuples().iterator():
+            yield NoteStatus(uuid, ndate, True)
 
     @_db.atomic()
     def wipe(self):
+        _NoteSearch.delete_all()
+        _NoteIndex.delete().execute()
+        _RenderedNote.delete().execute()
         _Note.delete().execute()
         _NoteTag.delete().execute()
         _RemovedNote.delete().execute()
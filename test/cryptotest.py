@@ -0,0 +1,107 @@
+# coding:utf-8
+from base64 import standard_b64decode
+from crossknight.ploc.crypto import has_native_aes
+from crossknight.ploc.crypto import has_native_argon2
+from crossknight.ploc.crypto import hkdf
+from crossknight.ploc.crypto import key_cache
+from crossknight.ploc.crypto import KeyCache
+from crossknight.ploc.crypto import NATIVE_BACKEND
+from crossknight.ploc.crypto import pass2key
+from crossknight.ploc.crypto import PURE_BACKEND
+from crossknight.ploc.crypto import wipe_keys
+from crossknight.ploc.domain import Note
+from datetime import datetime
+from sys import modules
+from types import ModuleType
+from unittest import TestCase
+
+
+class ModuleTest(TestCase):
+    SALT = bytes.fromhex("8306ef737874bd0cf8e2f2b5ff7a2ec5")
+    FILENAME_ENCRYPTED = "01d80488a18e42e6a2767b140d45ddb9.md"
+
+    def tearDown(self):
+        wipe_keys()
+
+    def testPass2KeyIsCached(self):
+        key1 = pass2key("hola", self.SALT)
+        key2 = pass2key("hola", self.SALT)
+
+        self.assertEqual(32, len(key1))
+        self.assertEqual(key1, key2)
+        self.assertEqual(key1, key_cache.get("hola", self.SALT))
+        self.assertIsNone(key_cache.get("chau", self.SALT))
+
+    def testKeyCacheEvictsLeastRecentlyUsed(self):
+        cache = KeyCache(maxsize=2)
+        cache.put("a", self.SALT, b"1")
+        cache.put("b", self.SALT, b"2")
+        cache.get("a", self.SALT)
+
+        cache.put("c", self.SALT, b"3")
+
+        self.assertEqual(2, len(cache))
+        self.assertEqual(b"1", cache.get("a", self.SALT))
+        self.assertIsNone(cache.get("b", self.SALT))
+        self.assertEqual(b"3", cache.get("c", self.SALT))
+
+    def testKeyCacheExpires(self):
+        cache = KeyCache(ttl=0)
+        cache.put("a", self.SALT, b"1")
+
+        self.assertIsNone(cache.get("a", self.SALT))
+        self.assertEqual(0, len(cache))
+
+    def testKeyCacheWipe(self):
+        cache = KeyCache()
+        cache.put("a", self.SALT, b"1")
+
+        cache.wipe()
+
+        self.assertEqual(0, len(cache))
+        self.assertIsNone(cache.get("a", self.SALT))
+
+    def testHkdf(self):
+        key = hkdf(bytes.fromhex("0b" * 22), bytes.fromhex("000102030405060708090a0b0c"),
+                   bytes.fromhex("f0f1f2f3f4f5f6f7f8f9"))
+
+        self.assertEqual("3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db02d56ecc4c5bf", key.hex())
+
+    def __read_resource(self):
+        with open("resources/" + self.FILENAME_ENCRYPTED, "rb") as file:
+            note = Note.from_text(self.FILENAME_ENCRYPTED, datetime.now(), file.read())
+        return bytes.fromhex(note.crypto.salt), bytes.fromhex(note.crypto.iv), standard_b64decode(note.text)
+
+    def testArgon2BackendsMatchOnResource(self):
+        if not has_native_argon2():
+            self.skipTest("argon2-cffi is not available")
+        salt, _, _ = self.__read_resource()
+
+        self.assertEqual(PURE_BACKEND.argon2d(b"hola", salt), NATIVE_BACKEND.argon2d(b"hola", salt))
+
+    def testAesBackendsMatchOnResource(self):
+        if not has_native_aes():
+            self.skipTest("cryptography is not available")
+        salt, iv, cipher = self.__read_resource()
+        key = pass2key("hola", salt)
+        data = bytes(range(256)) * 3
+
+        for backend in (PURE_BACKEND, NATIVE_BACKEND):
+            self.assertEqual(b"Hola mundo!", backend.decrypt(key, iv, cipher))
+            self.assertEqual(cipher, backend.encrypt(key, iv, b"Hola mundo!"))
+        self.assertEqual(PURE_BACKEND.encrypt(key, iv, data), NATIVE_BACKEND.encrypt(key, iv, data))
+        self.assertEqual(data, NATIVE_BACKEND.decrypt(key, iv, PURE_BACKEND.encrypt(key, iv, data)))
+
+    def testNativeBackendFallsBackOnPartialPackage(self):
+        saved = {name: module for (name, module) in modules.items() if name.split(".")[0] == "argon2"}
+        for name in saved:
+            del modules[name]
+        modules["argon2"] = ModuleType("argon2")
+        has_native_argon2.cache_clear()
+        try:
+            self.assertFalse(has_native_argon2())
+            self.assertEqual(PURE_BACKEND.argon2d(b"hola", self.SALT), NATIVE_BACKEND.argon2d(b"hola", self.SALT))
+        finally:
+            del modules["argon2"]
+            modules.update(saved)
+            has_native_argon2.cache_clear()
@@ -1,8 +1,23 @@
 # coding:utf-8
+from base64 import standard_b64decode
+from crossknight.ploc.crypto import Keyring
+from crossknight.ploc.crypto import pass2key
+from crossknight.ploc.crypto import PURE_BACKEND
+from crossknight.ploc.crypto import verified_cache
+from crossknight.ploc.crypto import wipe_keys
+from crossknight.ploc.crypto import SESSION_KDF
+# noinspection PyProtectedMember
+from crossknight.ploc.domain import _yaml_dumper
+from crossknight.ploc.domain import decrypt_many
+from crossknight.ploc.domain import encrypt_many
 from crossknight.ploc.domain import Note
+from crossknight.ploc.domain import NoteCrypto
 from crossknight.ploc.domain import NoteType
+from crossknight.ploc.domain import verify_password
+from collections import OrderedDict
 from datetime import datetime
 from unittest import TestCase
+from yaml import dump_all
 
 
 class ModuleTest(TestCase):
@@ -69,6 +84,90 @@ class ModuleTest(TestCase):
         self.assertEqual(str, type(note.text))
         self.assertEqual("Hola mundo!", note.text)
 
+    def testEncryptAndDecryptLargeNote(self):
+        note = Note()
+        note.text = "Camión ñandú 😀 " * 20000
+
+        self.assertTrue(note.encrypt("hola"))
+
+        key = pass2key("hola", bytes.fromhex(note.crypto.salt))
+        cipher = standard_b64decode(note.text)
+        self.assertEqual(("Camión ñandú 😀 " * 20000).encode("utf-8"),
+                         PURE_BACKEND.decrypt(key, bytes.fromhex(note.crypto.iv), cipher))
+        self.assertTrue(note.decrypt("hola"))
+        self.assertEqual("Camión ñandú 😀 " * 20000, note.text)
+
+    def testEncryptWithKeyringAndDecrypt(self):
+        keyring = Keyring("hola")
+        note1 = Note.from_text(self.FILENAME_PLAIN, datetime.now(), self.__read_file(self.FILENAME_PLAIN))
+        note2 = Note()
+        note2.text = "Chau mundo!"
+
+        self.assertTrue(note1.encrypt(keyring))
+        self.assertTrue(note2.encrypt(keyring))
+
+        self.assertEqual(SESSION_KDF, note1.crypto.kdf)
+        self.assertEqual(64, len(note1.crypto.salt))
+        self.assertEqual(note1.crypto.salt[:32], note2.crypto.salt[:32])
+        self.assertNotEqual(note1.crypto.salt[32:], note2.crypto.salt[32:])
+        note1 = Note.from_text(note1.uuid + ".md", note1.date, str(note1))
+        self.assertEqual(SESSION_KDF, note1.crypto.kdf)
+        self.assertFalse(note1.decrypt("chau"))
+        self.assertTrue(note1.decrypt("hola"))
+        self.assertEqual("Hola mundo!", note1.text)
+        self.assertTrue(note2.decrypt(keyring))
+        self.assertEqual("Chau mundo!", note2.text)
+
+    def testDecryptNoteWithKeyring(self):
+        note = Note.from_text(self.FILENAME_ENCRYPTED, datetime.now(), self.__read_file(self.FILENAME_ENCRYPTED))
+
+        result = note.decrypt(Keyring("hola"))
+
+        self.assertTrue(result)
+        self.assertEqual("Hola mundo!", note.text)
+
+    def testEncryptManyAndDecryptMany(self):
+        notes = [Note.from_text(self.FILENAME_PLAIN, datetime.now(), self.__read_file(self.FILENAME_PLAIN)), Note(),
+                 Note.from_text(self.FILENAME_ENCRYPTED, datetime.now(), self.__read_file(self.FILENAME_ENCRYPTED))]
+        notes[1].text = "Chau mundo!"
+
+        result = encrypt_many(notes, "hola", workers=2)
+
+        self.assertEqual([True, True, False], result)
+        self.assertTrue(all(note.crypto for note in notes))
+        self.assertNotEqual(notes[0].crypto.salt, notes[1].crypto.salt)
+
+        notes.insert(1, Note())
+        result = decrypt_many(notes, "hola", workers=2)
+
+        self.assertEqual([True, False, True, True], result)
+        self.assertEqual(["Hola mundo!", "", "Chau mundo!", "Hola mundo!"], [note.text for note in notes])
+        self.assertFalse(any(note.crypto for note in notes))
+
+    def testDecryptManyWithWrongPassword(self):
+        note = Note.from_text(self.FILENAME_ENCRYPTED, datetime.now(), self.__read_file(self.FILENAME_ENCRYPTED))
+
+        result = decrypt_many([note], "chau")
+
+        self.assertEqual([False], result)
+        self.assertEqual("QjyW7OaUyP7M2WR81CH8Eg==", note.text)
+
+    def testVerifyPassword(self):
+        wipe_keys()
+        keyring = Keyring("hola")
+        notes = [Note.from_text(self.FILENAME_ENCRYPTED, datetime.now(), self.__read_file(self.FILENAME_ENCRYPTED)),
+                 Note(), Note(), Note()]
+        notes[2].encrypt(keyring)
+        notes[3].encrypt(keyring)
+
+        self.assertEqual([False, False, False, False], verify_password(notes, "chau"))
+        self.assertEqual(0, len(verified_cache))
+        self.assertEqual([True, False, True, True], verify_password(notes, "hola"))
+        self.assertEqual(2, len(verified_cache))
+        self.assertEqual([True, False, True, True], verify_password(notes, keyring))
+        self.assertEqual("QjyW7OaUyP7M2WR81CH8Eg==", notes[0].text)
+        self.assertIsNotNone(notes[0].crypto)
+
     def testWriteNote(self):
         txt = self.__read_file(self.FILENAME_ENCRYPTED).decode("utf-8")
         note = Note.from_text(self.FILENAME_ENCRYPTED, datetime.now(), txt)
@@ -77,3 +176,34 @@ class ModuleTest(TestCase):
 
         self.assertEqual(str, type(result))
         self.assertEqual(txt, result)
+
+    def testWriteNoteMatchesYaml(self):
+        values = ["", " ", "Aaaaa", "!mañana", "it's", "'quoted'", "yes", "No", "null", "~", "1", "0b1", "1.5", "-1",
+                  "2018-12-25", "- item", "-item", "? x", ":x", "a: b", "a:b", "a #b", "a#b", "#a", "[a]", "a, b",
+                  "---", "...", ".5", "x" * 73, "x" * 74, "Camión"]
+        yamlValues = ["tab\there", "line\nbreak", "word " * 20, "😀"]
+        for value in values + yamlValues:
+            note = Note()
+            note.title = value
+            note.tags = [value, "AAA"]
+            note.crypto = NoteCrypto("12345678901234567890123456789012", "9ab105d4c753280ed7e9e5f9efe839d5",
+                                     "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825")
+            noteDict = OrderedDict([("title", value), ("tags", [value, "AAA"]), ("crypto", OrderedDict([
+                ("salt", note.crypto.salt), ("iv", note.crypto.iv), ("hmac", note.crypto.hmac)]))])
+            yaml = dump_all([noteDict], allow_unicode=True, default_flow_style=False, Dumper=_yaml_dumper())
+
+            result = str(note)
+
+            self.assertEqual("```yaml\n" + yaml.strip() + "\n```\n\n", result)
+            if value in values:
+                self.assertEqual(note, Note.from_text(note.uuid, note.date, result))
+                self.assertEqual(value, Note.from_text(note.uuid, note.date, result).title)
+                self.assertEqual([value, "AAA"], Note.from_text(note.uuid, note.date, result).tags)
+
+    def testReadAndWriteResources(self):
+        for filename in (self.FILENAME_ENCRYPTED, self.FILENAME_PLAIN):
+            txt = self.__read_file(filename).decode("utf-8")
+
+            note = Note.from_text(filename, datetime.now(), txt)
+
+            self.assertEqual(txt, str(note))
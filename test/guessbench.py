@@ -0,0 +1,70 @@
+# coding:utf-8
+from os.path import abspath
+from os.path import dirname
+from os.path import normpath
+from subprocess import run
+from sys import executable
+from sys import path
+from timeit import timeit
+testpath = dirname(abspath(__file__))
+path.append(normpath(testpath + "/../lib"))
+path.append(normpath(testpath + "/../src"))
+
+
+SAMPLES = (
+    "$ ls $HOME\n",
+    "import os\nprint(os.getcwd())\n",
+    "def f(x):\n    return x\n",
+    '{"a": [1, 2]}\n',
+    "<!DOCTYPE html>\n<html><body></body></html>\n",
+    '<?xml version="1.0"?>\n<a/>\n',
+    "SELECT * FROM note WHERE uuid = 1;\n",
+    "#include <stdio.h>\nint main() {}\n",
+    "--- a\n+++ b\n@@ -1 +1 @@\n-a\n+b\n",
+    "a: 1\nb: [2]\n",
+    "const x = () => 1;\n",
+    "hello\n",
+    "body { color: red; }\n",
+    "public class A { public static void main(String[] a) {} }\n",
+    "[section]\nkey=value\n",
+    "Hola, como estás? Todo bien.\n",
+)
+GUESSERS = {
+    "guess_lexer": "from pygments.lexers import guess_lexer",
+    "short list": "from crossknight.ploc.markdown import _guess_lexer as guess_lexer",
+}
+ROUNDS = 20
+COLD_SCRIPT = """
+import sys
+sys.path += %r
+from time import perf_counter
+%s
+start = perf_counter()
+for code in %r:
+    guess_lexer(code)
+print(perf_counter() - start)
+"""
+
+
+def cold(setup):
+    script = COLD_SCRIPT % (path[-2:], setup, SAMPLES)
+    return float(run([executable, "-W", "ignore", "-c", script], capture_output=True, check=True, text=True).stdout)
+
+
+def warm(setup):
+    namespace = {}
+    exec(setup, namespace)
+    guess = namespace["guess_lexer"]
+    for code in SAMPLES:
+        guess(code)
+    return timeit(lambda: [guess(code) for code in SAMPLES], number=ROUNDS) / ROUNDS / len(SAMPLES)
+
+
+def main():
+    print("%d sample blocks" % len(SAMPLES))
+    for (name, setup) in GUESSERS.items():
+        print("%-12s first call %7.1f ms, warm %7.3f ms per block" % (name, cold(setup) * 1000, warm(setup) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,19 @@
 # coding:utf-8
+from concurrent.futures import ThreadPoolExecutor
+from crossknight.ploc import markdown
+from crossknight.ploc.domain import Note
+from crossknight.ploc.domain import NoteCrypto
+from crossknight.ploc.highlight import stylesheet
+from crossknight.ploc.markdown import highlight_cache
+from crossknight.ploc.markdown import IncrementalRenderer
+from crossknight.ploc.markdown import MarkdownRenderer
 from crossknight.ploc.markdown import render
+from crossknight.ploc.markdown import render_cache
+from crossknight.ploc.markdown import render_exact
+from crossknight.ploc.markdown import render_many
+from random import Random
 from unittest import TestCase
+from unittest.mock import patch
 
 
 class ModuleTest(TestCase):
@@ -31,3 +44,172 @@ class ModuleTest(TestCase):
 
         expected = '<pre><code class="language-bash">$ ls <span class="pygm-nv">$HOME</span>\n$ ls /etc\n</code></pre>'
         self.assertEqual(expected, html.strip())
+
+    def testRenderIsCached(self):
+        render_cache.clear()
+
+        html1 = render("Hello, *cache*!")
+        html2 = render("Hello, *cache*!")
+
+        self.assertIs(html1, html2)
+        self.assertEqual(1, len(render_cache))
+
+    def testHighlightIsCachedPerBlock(self):
+        highlight_cache.clear()
+
+        html1 = render("One\n\n```python\nprint(1)\n```\n\n```\nplain\n```")
+        html2 = render("Two\n\n```python\nprint(1)\n```")
+
+        self.assertEqual(2, len(highlight_cache))
+        self.assertIn(html2[html2.index("<pre>"):], html1)
+
+    def testRenderGuessesCommonLanguages(self):
+        samples = {"python": "def f(x):\n    return x", "json": '{"a": [1, 2]}', "sql": "SELECT * FROM note;",
+                   "javascript": "const x = () => 1;", "diff": "--- a\n+++ b\n@@ -1 +1 @@\n-a\n+b"}
+        for (language, code) in samples.items():
+            html = render("```\n" + code + "\n```")
+
+            self.assertTrue(html.startswith('<pre><code class="language-%s">' % language), html)
+
+    def testRenderWithoutGuessFallback(self):
+        markdown.guess_fallback = None
+        try:
+            html = render("```\nhello, there\n```")
+        finally:
+            markdown.guess_fallback = "text"
+
+        self.assertEqual("<pre><code>hello, there\n</code></pre>", html.strip())
+
+    def testRenderWithUnknownLanguagesKeepsLexerCacheBounded(self):
+        for i in range(200):
+            html = render("```nolang%d\nhello\n```" % i)
+
+            self.assertIn('<code class="language-textonly">hello', html)
+        # noinspection PyProtectedMember
+        self.assertLessEqual(markdown._lexer_by_name.cache_info().currsize, 64)
+
+    def testMarkdownRendererDiscardsStateOfFailedParse(self):
+        renderer = MarkdownRenderer()
+        with patch("crossknight.ploc.highlight.HighlightRenderer.block_code", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                renderer.render("[x]: http://evil.example\n\n[^n]: foot\n\n```\ncode\n```")
+
+        html = renderer.render("See [x] here.")
+
+        self.assertEqual("<p>See [x] here.</p>", html.strip())
+
+    def testMarkdownRendererIsReusable(self):
+        renderer = MarkdownRenderer()
+
+        html1 = renderer.render("See [the docs][1].\n\n[1]: http://example.com")
+        html2 = renderer.render("See [the docs][1].")
+
+        self.assertEqual('<p>See <a href="http://example.com">the docs</a>.</p>', html1.strip())
+        self.assertEqual("<p>See [the docs][1].</p>", html2.strip())
+
+    def testMarkdownRendererAcrossThreads(self):
+        renderer = MarkdownRenderer()
+        texts = ["# Title %d\n\n```python\nx = %d\n```\n\nSome *text*." % (i, i) for i in range(40)]
+
+        with ThreadPoolExecutor(4) as executor:
+            htmls = list(executor.map(renderer.render, texts))
+
+        self.assertEqual([MarkdownRenderer().render(text) for text in texts], htmls)
+
+    def testRenderMany(self):
+        note1 = Note()
+        note1.text = "Hello, *note*!"
+        note2 = Note()
+        note2.crypto = NoteCrypto("8306ef737874bd0cf8e2f2b5ff7a2ec5", "9ab105d4c753280ed7e9e5f9efe839d5",
+                                  "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825")
+        note2.text = "QjyW7OaUyP7M2WR81CH8Eg=="
+        texts = ["Text **%d**" % i for i in range(50)]
+
+        htmls = render_many([note1, note2] + texts, workers=2, chunk_size=8)
+
+        self.assertEqual(52, len(htmls))
+        self.assertEqual(render("Hello, *note*!"), htmls[0])
+        self.assertIsNone(htmls[1])
+        self.assertEqual([render(text) for text in texts], htmls[2:])
+        self.assertEqual(htmls, render_many([note1, note2] + texts))
+
+    def testIncrementalRender(self):
+        text = "# Title\n\nFirst *paragraph*.\n\n- a\n- b\n\n- c\n\n```python\nx = 1\n\ny = 2\n```\n\n> quote\n\n> more"
+        renderer = IncrementalRenderer()
+
+        html, changed = renderer.render(text)
+
+        self.assertEqual(render(text), html)
+        self.assertEqual([(0, 5)], changed)
+        self.assertEqual(5, len(renderer.blocks))
+
+        html, changed = renderer.render(text.replace("First", "Second") + "\n\nLast")
+
+        self.assertEqual(render(text.replace("First", "Second") + "\n\nLast"), html)
+        self.assertEqual([(1, 2), (5, 6)], changed)
+
+        html, changed = renderer.render("Intro\n\n" + text.replace("First", "Second"))
+
+        self.assertEqual([(0, 1), (6, 6)], changed)
+
+    def testIncrementalRenderWithLinkDefinitions(self):
+        text = "See [x].\n\n[x]: http://example.com"
+        renderer = IncrementalRenderer()
+
+        html, changed = renderer.render(text)
+
+        self.assertEqual(render(text), html)
+        self.assertEqual([(0, 1)], changed)
+
+    def testIncrementalRenderMatchesRender(self):
+        pieces = ("Steps:", "1. Install", "2. Run", "- a", "* b", "  continued", "    code", "> quote", "lazy line",
+                  "<div>", "</div>", "<!-- c -->", "```", "```python", "~~~", "# Head", "Title", "===", "---",
+                  "| a | b |", "|---|---|", "| 1 | 2 |", "a | b", "--|--", "\tTabbed", "<table>", "", "", "   ")
+        corpus = ["Steps:\n1. Install\n\n2. Run\n", "<div>\n\n\n</div>", "> a\n\n> b\nlazy\n\nend",
+                  "- a\n\n  more\n\n- b\n\nafter", "| a | b |\n|---|---|\n\n</div>\n", "<table>\n\n    code"]
+        generator = Random(0)
+        for _ in range(500):
+            corpus.append("\n".join(generator.choice(pieces) for _ in range(generator.randint(1, 12))))
+
+        for text in corpus:
+            self.assertEqual(render(text), IncrementalRenderer().render(text)[0], text)
+
+    def testStylesheet(self):
+        css = stylesheet()
+
+        self.assertIn("pre .pygm-k {", css)
+        self.assertIs(css, stylesheet())
+        self.assertIn(".code .pygm-k {", stylesheet("monokai", ".code"))
+
+    def testRenderWithLimits(self):
+        markdown.max_input_size = 28
+        markdown.max_code_size = 8
+        try:
+            html1, exact1 = render_exact("# Too *long* for the limit <b>")
+            html2 = render("```python\nprint(12345)\n```")
+        finally:
+            markdown.max_input_size = 1 << 20
+            markdown.max_code_size = 1 << 16
+
+        self.assertEqual("<pre># Too *long* for the limit &lt;b&gt;</pre>", html1.strip())
+        self.assertFalse(exact1)
+        self.assertEqual('<pre><code class="lang-python">print(12345)\n</code></pre>', html2.strip())
+        html3 = render("# Too *long* for the limit <b>")
+        self.assertEqual("<h1>Too <em>long</em> for the limit <b></h1>", html3.strip())
+        self.assertIn('class="language-python"', render("```python\nprint(12345)\n```"))
+
+    def testRenderWithTimeout(self):
+        markdown.render_timeout = 30
+        try:
+            html1 = render("Hello, *worker*!")
+            cached = len(render_cache)
+            markdown.render_timeout = 0.05
+            html2, exact2 = render_exact("".join("Hello, *timeout*!\n\n```python\nx = %d\n```\n\n" % i
+                                                 for i in range(5000)))
+        finally:
+            markdown.render_timeout = None
+
+        self.assertEqual("<p>Hello, <em>worker</em>!</p>", html1.strip())
+        self.assertTrue(html2.startswith("<pre>Hello, *timeout*!\n\n```python\nx = 0\n```"))
+        self.assertFalse(exact2)
+        self.assertEqual(cached, len(render_cache))
@@ -0,0 +1,27 @@
+# coding:utf-8
+from concurrent.futures import ThreadPoolExecutor
+from crossknight.ploc.parallel import imap
+from unittest import TestCase
+
+
+class ModuleTest(TestCase):
+
+    def testImap(self):
+        with ThreadPoolExecutor(2) as executor:
+            results = list(imap(executor, lambda x: x * x, iter(range(10)), 3))
+
+        self.assertEqual([x * x for x in range(10)], results)
+
+    def testImapIsBoundedByWindow(self):
+        submitted = []
+
+        def items():
+            for x in range(10):
+                submitted.append(x)
+                yield x
+
+        with ThreadPoolExecutor(2) as executor:
+            results = imap(executor, str, items(), 3)
+            self.assertEqual("0", next(results))
+            self.assertEqual(3, len(submitted))
+            self.assertEqual([str(x) for x in range(1, 10)], list(results))
@@ -1,15 +1,28 @@
 # coding:utf-8
+from crossknight.ploc import markdown
 from crossknight.ploc.domain import Note
 from crossknight.ploc.domain import NoteCrypto
 from crossknight.ploc.domain import NoteType
+# noinspection PyProtectedMember
+from crossknight.ploc.sqlite import _RenderedNote
 from crossknight.ploc.sqlite import Provider
+from os import listdir
 from os import remove
 from peewee import DoesNotExist
 from peewee import IntegrityError
+from subprocess import run
+from sys import executable
+from sys import path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+from zipfile import ZipFile
 
 
 class ModuleTest(TestCase):
+    IMPORT_BUDGET = 1.0
 
     def setUp(self):
         self.provider = Provider()
@@ -18,6 +31,22 @@ class ModuleTest(TestCase):
         self.provider.close()
         remove(self.provider.filename)
 
+    def testImportIsLazy(self):
+        code = "import sys, time; sys.path = %r; start = time.perf_counter(); import crossknight.ploc.sqlite; " \
+               "print(time.perf_counter() - start); print(' '.join(sorted(sys.modules)))" % path
+
+        lines = run([executable, "-W", "ignore", "-c", code], capture_output=True, check=True, text=True).stdout\
+            .splitlines()
+
+        self.assertLess(float(lines[0]), self.IMPORT_BUDGET)
+        for module in ("argon2pure", "mistune", "pyaes", "pygments", "yaml"):
+            self.assertNotIn(module, lines[1].split())
+
+    def testOldSqliteMustFail(self):
+        with patch("crossknight.ploc.sqlite.sqlite_version_info", (3, 33, 0)):
+            with self.assertRaisesRegex(RuntimeError, "SQLite 3.34.0 or later"):
+                Provider()
+
     def testList(self):
         note1 = Note()
         self.provider.add(note1)
@@ -65,6 +94,106 @@ class ModuleTest(TestCase):
         self.assertEqual(note3.type, res[2].type)
         self.assertEqual(note3.crypto, res[2].crypto)
 
+    def testListByText(self):
+        note1 = Note()
+        note1.title = "Camión"
+        self.provider.add(note1)
+        note2 = Note()
+        note2.title = "Otro"
+        note2.tags = ["CAMIONES"]
+        self.provider.add(note2)
+        note3 = Note()
+        note3.text = "Un camion rojo"
+        self.provider.add(note3)
+        note4 = Note()
+        note4.crypto = NoteCrypto("8306ef737874bd0cf8e22225ff7a2ec5", "9ab105d4c753280ed7e9e5f9efe839d5",
+                                  "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825")
+        note4.text = "camion"
+        self.provider.add(note4)
+        note1.title = "Tren"
+        self.provider.update(note1)
+        self.provider.update_tag("CAMIONES", ["CAMIÓN"])
+        self.provider.remove(note3.uuid)
+
+        res = self.provider.list(text="cAmIon")
+
+        self.assertEqual(1, len(res))
+        self.assertEqual(note2.uuid, res[0].uuid)
+        self.assertEqual(["CAMIÓN"], res[0].tags)
+
+    def testListRanked(self):
+        note1 = Note()
+        note1.title = "Diario"
+        note1.text = "Ayer fui al mercado y después pasé por la panadería."
+        self.provider.add(note1)
+        note2 = Note()
+        note2.title = "Panadería"
+        note2.text = "Pan y facturas"
+        self.provider.add(note2)
+        note3 = Note()
+        note3.title = "Otra"
+        self.provider.add(note3)
+
+        res = self.provider.list(text="panaderia", ranked=True)
+
+        self.assertEqual(2, len(res))
+        self.assertEqual(note2.uuid, res[0].uuid)
+        self.assertEqual("Pan y facturas", res[0].snippet)
+        self.assertEqual(note1.uuid, res[1].uuid)
+        self.assertIn("<mark>panadería</mark>", res[1].snippet)
+
+    def testListRankedEscapesSnippet(self):
+        note = Note()
+        note.title = "Receta"
+        note.text = '<img src=x onerror=alert(1)> panadería <a href="javascript:evil()">' + "x " * 100
+        self.provider.add(note)
+
+        res = self.provider.list(text="panaderia", ranked=True)
+
+        self.assertEqual(1, len(res))
+        self.assertTrue(res[0].snippet.startswith("&lt;img src=x onerror=alert(1)&gt; <mark>panadería</mark> "
+                                                  "&lt;a href=&quot;javascript:evil()&quot;"), res[0].snippet)
+        self.assertNotIn("<img", res[0].snippet)
+        self.assertNotIn("<a ", res[0].snippet)
+
+    def testListRankedIgnoresSentinelCharactersInText(self):
+        note = Note()
+        note.title = "Receta"
+        note.text = "a\x03b panadería \x02c\x03 " + "x " * 100
+        self.provider.add(note)
+
+        res = self.provider.list(text="panaderia", ranked=True)
+
+        self.assertEqual(1, len(res))
+        self.assertTrue(res[0].snippet.startswith("a\x03b <mark>panadería</mark> \x02c\x03 "), res[0].snippet)
+        self.assertEqual(1, res[0].snippet.count("<mark>"))
+        self.assertEqual(1, res[0].snippet.count("</mark>"))
+
+    def testListPage(self):
+        titles = ["delta", "Árbol", "charlie", "bravo", "Alfa"]
+        for title in titles:
+            note = Note()
+            note.title = title
+            self.provider.add(note)
+
+        page1, cursor1 = self.provider.list_page(limit=2)
+        page2, cursor2 = self.provider.list_page(cursor1, limit=2)
+        page3, cursor3 = self.provider.list_page(cursor2, limit=2)
+
+        self.assertEqual(["Alfa", "Árbol"], [s.title for s in page1])
+        self.assertEqual(["bravo", "charlie"], [s.title for s in page2])
+        self.assertEqual(["delta"], [s.title for s in page3])
+        self.assertIsNotNone(cursor1)
+        self.assertIsNotNone(cursor2)
+        self.assertIsNone(cursor3)
+
+    def testListPageWithInvalidLimitMustFail(self):
+        self.provider.add(Note())
+
+        for limit in (0, -1):
+            with self.assertRaises(ValueError):
+                self.provider.list_page(limit=limit)
+
     def testAddAndGetNote(self):
         note = Note()
         note.title = "AAAA"
@@ -94,6 +223,18 @@ class ModuleTest(TestCase):
         self.assertEqual(str, type(res.text))
         self.assertEqual(note.text, res.text)
 
+    def testAddAndGetNoteWithKdf(self):
+        note = Note()
+        note.crypto = NoteCrypto("8306ef737874bd0cf8e2f2b5ff7a2ec58306ef737874bd0cf8e2f2b5ff7a2ec5",
+                                 "9ab105d4c753280ed7e9e5f9efe839d5",
+                                 "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825", "hkdf-sha256")
+        note.text = "QjyW7OaUyP7M2WR81CH8Eg=="
+
+        self.provider.add(note)
+
+        self.assertEqual(note.crypto, self.provider.get(note.uuid).crypto)
+        self.assertEqual(note.crypto, self.provider.list()[0].crypto)
+
     def testAddSameNoteTwiceMustFail(self):
         note = Note()
         self.provider.add(note)
@@ -104,6 +245,42 @@ class ModuleTest(TestCase):
         except IntegrityError:
             pass
 
+    def testAddMany(self):
+        note1 = Note()
+        note1.title = "Uno"
+        note1.tags = ["AAA"]
+        self.provider.add(note1)
+        note2 = Note()
+        note2.title = "Dos"
+        note2.tags = ["AAA", "BBB"]
+        note1.title = "Otro uno"
+
+        res = self.provider.add_many([note1, note2, note2], on_conflict="ignore")
+
+        self.assertEqual([False, True, False], res)
+        self.assertEqual("Uno", self.provider.get(note1.uuid).title)
+        self.assertEqual(note2, self.provider.get(note2.uuid))
+        self.assertEqual(["AAA", "BBB"], self.provider.tags())
+        self.assertEqual([note2.uuid], [s.uuid for s in self.provider.list(text="dos")])
+
+        res = self.provider.add_many([note1], on_conflict="replace")
+
+        self.assertEqual([True], res)
+        self.assertEqual("Otro uno", self.provider.get(note1.uuid).title)
+
+    def testAddManyMustFailOnConflict(self):
+        note1 = Note()
+        self.provider.add(note1)
+        note2 = Note()
+
+        try:
+            self.provider.add_many([note2, note1])
+            self.fail("Expected an error")
+        except IntegrityError:
+            pass
+
+        self.assertEqual([note1.uuid], [s.uuid for s in self.provider.list()])
+
     def testUpdateNote(self):
         note = Note()
         note.title = "Hola"
@@ -118,6 +295,47 @@ class ModuleTest(TestCase):
         self.assertEqual(note.title, res.title)
         self.assertEqual(note.tags, res.tags)
 
+    def testRenderHtml(self):
+        self.provider.persist_html = True
+        note1 = Note()
+        note1.text = "Hola **mundo**!"
+        self.provider.add(note1)
+        note2 = Note()
+        note2.crypto = NoteCrypto("8306ef737874bd0cf8e22225ff7a2ec5", "9ab105d4c753280ed7e9e5f9efe839d5",
+                                  "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825")
+        note2.text = "QjyW7OaUyP7M2WR81CH8Eg=="
+        self.provider.add(note2)
+
+        self.assertEqual("<p>Hola <strong>mundo</strong>!</p>", self.provider.render_html(note1.uuid).strip())
+        self.assertEqual(1, _RenderedNote.select().count())
+        self.assertEqual("<p>Hola <strong>mundo</strong>!</p>", self.provider.render_html(note1.uuid).strip())
+        self.assertIsNone(self.provider.render_html(note2.uuid))
+
+        note1.text = "Chau *mundo*!"
+        self.provider.update(note1)
+
+        self.assertEqual(0, _RenderedNote.select().count())
+        self.assertEqual("<p>Chau <em>mundo</em>!</p>", self.provider.render_html(note1.uuid).strip())
+        self.provider.remove(note1.uuid)
+        self.assertEqual(0, _RenderedNote.select().count())
+
+    def testRenderHtmlDoesNotPersistFallback(self):
+        self.provider.persist_html = True
+        note = Note()
+        note.text = "Hola **mundo**!"
+        self.provider.add(note)
+
+        markdown.max_input_size = 4
+        try:
+            html = self.provider.render_html(note.uuid)
+        finally:
+            markdown.max_input_size = 1 << 20
+
+        self.assertEqual("<pre>Hola **mundo**!</pre>", html.strip())
+        self.assertEqual(0, _RenderedNote.select().count())
+        self.assertEqual("<p>Hola <strong>mundo</strong>!</p>", self.provider.render_html(note.uuid).strip())
+        self.assertEqual(1, _RenderedNote.select().count())
+
     def testRemoveNote(self):
         note = Note()
         self.provider.add(note)
@@ -145,6 +363,15 @@ class ModuleTest(TestCase):
         self.assertEqual("master", tags[1])
         self.assertEqual("slave", tags[2])
 
+    def testTagsWithAccents(self):
+        note = Note()
+        note.tags = ["ñu", "Ökonomie", "nz", "oa"]
+        self.provider.add(note)
+
+        tags = self.provider.tags()
+
+        self.assertEqual(["ñu", "nz", "oa", "Ökonomie"], tags)
+
     def testUpdateTagToRemoveOnly(self):
         note1 = Note()
         note1.tags = ["AAA", "BBB"]
@@ -204,6 +431,53 @@ class ModuleTest(TestCase):
         self.assertEqual(note1, self.provider.get(note1.uuid))
         self.assertEqual(note2, self.provider.get(note2.uuid))
 
+    def testExportHtml(self):
+        notes = [Note() for _ in range(5)]
+        for (i, note) in enumerate(notes):
+            note.text = "Nota *%d*" % i
+        notes[2].crypto = NoteCrypto("8306ef737874bd0cf8e2f2b5ff7a2ec5", "9ab105d4c753280ed7e9e5f9efe839d5",
+                                     "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825")
+        self.provider.add_many(notes)
+
+        with TemporaryDirectory() as dirpath:
+            result = self.provider.export_html([n.uuid for n in notes], dirpath, workers=2)
+
+            self.assertEqual(4, result)
+            self.assertEqual(sorted(n.uuid + ".html" for n in notes if not n.crypto), sorted(listdir(dirpath)))
+            with open(dirpath + "/" + notes[3].uuid + ".html", encoding="utf-8") as file:
+                self.assertEqual("<p>Nota <em>3</em></p>", file.read().strip())
+
+    def testExportStoringEncrypted(self):
+        filepath = "temp-export.zip"
+        note1 = Note()
+        note1.text = "Hola mundo!"
+        self.provider.add(note1)
+        note2 = Note()
+        note2.crypto = NoteCrypto("8306ef737874bd0cf8e2f2b5ff7a2ec5", "9ab105d4c753280ed7e9e5f9efe839d5",
+                                  "f3276c88bce9ec0e559fe07a39d1c3aac551d635679c25dc07322b70ab6eb825")
+        note2.text = "QjyW7OaUyP7M2WR81CH8Eg=="
+        self.provider.add(note2)
+
+        self.provider.export([note1.uuid, note2.uuid], filepath, compresslevel=9, store_encrypted=True)
+
+        with ZipFile(filepath) as zipped:
+            self.assertEqual(ZIP_DEFLATED, zipped.getinfo(note1.uuid + ".md").compress_type)
+            self.assertEqual(ZIP_STORED, zipped.getinfo(note2.uuid + ".md").compress_type)
+        self.provider.wipe()
+        self.provider.import_from(filepath)
+        remove(filepath)
+        self.assertEqual(note1, self.provider.get(note1.uuid))
+        self.assertEqual(note2, self.provider.get(note2.uuid))
+
+    def testExportMissingNoteMustFail(self):
+        try:
+            self.provider.export([Note().uuid], "temp-export.zip")
+            self.fail("Expected an error")
+        except DoesNotExist:
+            pass
+        finally:
+            remove("temp-export.zip")
+
     def testImport(self):
         filepath = "resources/import.zip"
         imported, duplicated, corrupted = self.provider.import_from(filepath)
@@ -226,6 +500,67 @@ class ModuleTest(TestCase):
         self.assertEqual(1, duplicated)
         self.assertEqual(1, corrupted)
 
+    def testImportWithWorkers(self):
+        filepath = "resources/import.zip"
+
+        imported, duplicated, corrupted = self.provider.import_from(filepath, workers=2)
+
+        self.assertEqual(1, imported)
+        self.assertEqual(0, duplicated)
+        self.assertEqual(1, corrupted)
+        self.assertEqual("Hola mundo!", self.provider.get("01d80488a18e42e6a2767b140d45ddc9").text)
+
+    def testImportInChunks(self):
+        filepath = "temp-export.zip"
+        notes = [Note(), Note(), Note()]
+        for note in notes:
+            self.provider.add(note)
+        self.provider.export([n.uuid for n in notes], filepath)
+        self.provider.wipe()
+        self.provider.add(notes[1])
+
+        imported, duplicated, corrupted = self.provider.import_from(filepath, chunk_size=2)
+
+        remove(filepath)
+        self.assertEqual(2, imported)
+        self.assertEqual(1, duplicated)
+        self.assertEqual(0, corrupted)
+        for note in notes:
+            self.assertEqual(note, self.provider.get(note.uuid))
+
+    def testImportSkipsMalformedNote(self):
+        filepath = "temp-import.zip"
+        with ZipFile(filepath, "w") as zipped:
+            zipped.write("resources/01d80488a18e42e6a2767b140d45ddc9.md", "01d80488a18e42e6a2767b140d45ddc9.md")
+            zipped.writestr("01d80488a18e42e6a2767b140d45ddd9.md", "```yaml\ntitle:\ntags: []\n```\n\nHola!")
+
+        imported, duplicated, corrupted = self.provider.import_from(filepath)
+
+        remove(filepath)
+        self.assertEqual(1, imported)
+        self.assertEqual(0, duplicated)
+        self.assertEqual(1, corrupted)
+        self.assertEqual("Hola mundo!", self.provider.get("01d80488a18e42e6a2767b140d45ddc9").text)
+
+    def testImportSkipsUnreadableNote(self):
+        filepath = "temp-import.zip"
+        with ZipFile(filepath, "w") as zipped:
+            zipped.write("resources/01d80488a18e42e6a2767b140d45ddc9.md", "01d80488a18e42e6a2767b140d45ddc9.md")
+            zipped.writestr("01d80488a18e42e6a2767b140d45ddd9.md", "```yaml\ntitle: [unclosed\ntags: []\n```\n\nHola!")
+            zipped.writestr("01d80488a18e42e6a2767b140d45dde9.md", "```yaml\ntitle: Crc\ntags: []\n```\n\nBroken CRC!")
+        with open(filepath, "rb") as file:
+            data = file.read()
+        with open(filepath, "wb") as file:
+            file.write(data.replace(b"Broken CRC!", b"Broken crc!"))
+
+        imported, duplicated, corrupted = self.provider.import_from(filepath)
+
+        remove(filepath)
+        self.assertEqual(1, imported)
+        self.assertEqual(0, duplicated)
+        self.assertEqual(2, corrupted)
+        self.assertEqual("Hola mundo!", self.provider.get("01d80488a18e42e6a2767b140d45ddc9").text)
+
     def testState(self):
         note1 = Note()
         self.provider.remove(note1.uuid)
@@ -242,6 +577,21 @@ class ModuleTest(TestCase):
         self.assertEqual(note2.date, res[note2.uuid].date)
         self.assertTrue(res[note2.uuid].active)
 
+    def testIterState(self):
+        note1 = Note()
+        self.provider.remove(note1.uuid)
+        self.provider.add(note1)
+        note2 = Note()
+        self.provider.remove(note2.uuid)
+
+        res = list(self.provider.iter_state())
+
+        self.assertEqual(2, len(res))
+        self.assertEqual(note2.uuid, res[0].uuid)
+        self.assertFalse(res[0].active)
+        self.assertEqual(note1.uuid, res[1].uuid)
+        self.assertTrue(res[1].active)
+
     def testWipe(self):
         note1 = Note()
         self.provider.remove(note1.uuid)